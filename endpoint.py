@@ -1,5 +1,6 @@
 import os, sys, glob, shutil
 import lib.stegocodecs.rgb_grid
+import lib.stegocodecs.yuv_grid
 import lib.peerconnection
 import lib.videostream
 import time
@@ -17,6 +18,13 @@ log_file_path = './error.log'
 logging.basicConfig(filename=log_file_path, level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
 
 config = Config()
+
+# Codecs that can be picked with STEGO_CODEC in config.json, both peers need the same one
+CODECS = {
+    "rgb_grid" : lib.stegocodecs.rgb_grid.Codec,
+    "yuv_grid" : lib.stegocodecs.yuv_grid.Codec
+}
+
 msg = None
 stdscr = None
 
@@ -350,17 +358,25 @@ if __name__ == "__main__":
 
     msg = AppMessages()
     shared_input = lib.lockvar.LockVar({"id":None, "prompt":None, "response":None})
-    videoStream = lib.videostream.VideoStream(config.RECV_VIDEO_URL,lib.stegocodecs.rgb_grid.Codec,msg,args)
+    codec = CODECS.get(getattr(config, "STEGO_CODEC", "rgb_grid"))
+    if codec is None:
+        print("Unknown STEGO_CODEC "+str(config.STEGO_CODEC)+", valid codecs are: "+", ".join(CODECS))
+        sys.exit(1)
+    videoStream = lib.videostream.VideoStream(config.RECV_VIDEO_URL,codec,msg,args)
     conn = lib.peerconnection.PeerConnection(videoStream, shared_input,msg,args)
 
+    # Only the bmp capture mode leaves frames on disk
+    capture_to_disk = config.VIDEO_STREAM_PARAMS.get("capture_mode", "pipe") == "bmp"
     if args.basic_output:
-        purge_temp_files()
+        if capture_to_disk:
+            purge_temp_files()
         main()
     else:
         if check_terminal_size() == False:
             sys.exit("Terminal window is not large enough, make it bigger or use --basic_output")
         os.system('clear')
-        purge_temp_files()
+        if capture_to_disk:
+            purge_temp_files()
         curses.wrapper(curses_main)
     
 
@@ -0,0 +1,159 @@
+import multiprocessing
+import threading
+import collections
+import queue
+import time
+import traceback
+import numpy as np
+from .framering import attach_frames
+
+# Seconds get_results waits on the results before checking whether a worker died
+WORKER_POLL_INTERVAL = 1
+# A worker that keeps dying is replaced this many times, after that the pool carries on without it
+WORKER_RESPAWNS = 3
+
+
+class WorkerMessages:
+    # Workers have no terminal, anything worth reporting comes back with the result
+    def print(self, text, verbose=0):
+        pass
+
+    def set_status(self, key, text):
+        pass
+
+
+# Reads box colors from captured frames in separate processes, so decoding isn't limited to the one core the GIL allows.
+# Workers read the frames from a FrameRing's shared memory, they only get the slot number. Classifying and framing
+# stay with the caller's codec since calibration and capture combining depend on the frames before, in order.
+class DecodePool:
+
+    def __init__(self, codec, codec_params, workers, ring):
+        context = multiprocessing.get_context("spawn")
+        self.context = context
+        self.codec_class = type(codec)
+        self.codec_params = codec_params
+        self.msg = codec.msg
+        self.ring = ring
+        self.workers = workers
+        # One frame per worker at a time, the rest wait in the ring where they can still be dropped or skipped
+        self.idle_workers = threading.Semaphore(workers)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.submitted = collections.deque()
+        self.pending = {}
+        self.busy_time = [0] * workers
+        self.start_time = time.time()
+        # (frame_index, slot) each worker is decoding, -1 when idle, so a frame isn't lost with a worker that dies
+        self.current = context.Array('q', [-1] * 2 * workers, lock=False)
+        self.respawns = [0] * workers
+        self.finished = set()
+        self.processes = [None] * workers
+        for worker_id in range(workers):
+            self.__start_worker(worker_id)
+
+    def __start_worker(self, worker_id):
+        self.current[2 * worker_id] = -1
+        process = self.context.Process(target=decode_worker, name="DecodeWorker-"+str(worker_id), daemon=True,
+                                       args=(worker_id, self.codec_class, self.codec_params, self.ring.name, self.ring.size,
+                                             self.ring.frame_shape, self.tasks, self.results, self.current))
+        process.start()
+        self.processes[worker_id] = process
+
+    def wait_for_worker(self):
+        self.idle_workers.acquire()
+
+    def submit(self, frame_index, slot, realign_count):
+        # Call wait_for_worker first, results come back in the order frames were submitted
+        self.submitted.append(frame_index)
+        self.tasks.put((frame_index, slot, realign_count))
+
+    def finish(self):
+        # Workers exit once everything submitted so far is done, get_results then stops
+        for process in self.processes:
+            self.tasks.put(None)
+
+    def get_results(self):
+        # Yields (frame_index, slot, box_averages, error) in the order frames were submitted until every worker has finished.
+        # A frame whose worker died comes back with an error
+        while len(self.finished) < self.workers:
+            while self.submitted and self.submitted[0] in self.pending:
+                yield self.pending.pop(self.submitted.popleft())
+                # Only once the caller is done with the result, so the next frame is submitted knowing how this one decoded
+                self.idle_workers.release()
+            self.__check_workers()
+            try:
+                item = self.results.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if item[0] is None:
+                self.finished.add(item[1])
+                continue
+            frame_index, slot, box_averages, error, worker_id, busy_time = item
+            self.busy_time[worker_id] += busy_time
+            # Already handed back with an error if its worker was taken for dead
+            if frame_index in self.submitted:
+                self.pending[frame_index] = (frame_index, slot, box_averages, error)
+        # Anything left over is out of order because a worker died, hand it back anyway so its slot is released
+        for frame_index in sorted(self.pending):
+            yield self.pending.pop(frame_index)
+        self.submitted.clear()
+
+    def __check_workers(self):
+        # Workers only exit on their own after finish, with exit code 0 once their sentinel is sent
+        for worker_id, process in enumerate(self.processes):
+            if worker_id in self.finished or process.is_alive() or process.exitcode == 0:
+                continue
+            self.msg.print("Decode worker "+str(worker_id)+" died with exit code "+str(process.exitcode))
+            frame_index, slot = self.current[2 * worker_id], self.current[2 * worker_id + 1]
+            if frame_index >= 0 and frame_index in self.submitted and frame_index not in self.pending:
+                self.pending[frame_index] = (frame_index, slot, None, "Decode worker "+str(worker_id)+" died")
+            if self.respawns[worker_id] < WORKER_RESPAWNS:
+                self.respawns[worker_id] += 1
+                self.__start_worker(worker_id)
+            else:
+                self.msg.print("Decode worker "+str(worker_id)+" keeps dying, continuing without it")
+                self.finished.add(worker_id)
+
+    def utilization(self):
+        # Percent of the time since the pool started each worker spent decoding
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        return [round(busy_time / elapsed * 100, 1) for busy_time in self.busy_time]
+
+    def close(self):
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+
+
+def decode_worker(worker_id, codec_class, codec_params, ring_name, ring_size, frame_shape, tasks, results, current):
+    buffer, frames = attach_frames(ring_name, ring_size, frame_shape)
+    codec = None
+    realign_count = 0
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        frame_index, slot, task_realign_count = task
+        current[2 * worker_id + 1] = slot
+        current[2 * worker_id] = frame_index
+        start_time = time.time()
+        box_averages = None
+        error = None
+        try:
+            # Follow the alignment of the codec that classifies the results
+            if codec is None:
+                codec = codec_class(WorkerMessages(), params=codec_params)
+            elif task_realign_count != realign_count:
+                codec.realign()
+            realign_count = task_realign_count
+            box_averages = codec.get_stack_box_averages(frames[slot][np.newaxis])[0]
+        except Exception:
+            error = traceback.format_exc()
+        results.put((frame_index, slot, box_averages, error, worker_id, time.time() - start_time))
+        current[2 * worker_id] = -1
+
+    frames = []
+    buffer.close()
+    results.put((None, worker_id))
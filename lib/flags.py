@@ -10,6 +10,7 @@ class Flags:
     MAINT = 5   
     MOD = 6  #OPTION, SHIFT, MODIFIER, MOD, SWITCH
     FIN = 7  
+    SACK = 8  # A SACK bitmap comes before the data
 
     @staticmethod
     def get_bin(flags, flags_byte=None):
@@ -0,0 +1,35 @@
+import threading
+import collections
+
+
+# Least recently used cache bounded by the total size of what it holds, given in MB.
+# Sizes are whatever the caller passes to put, usually the bytes of the arrays in the value
+class FrameCache:
+
+    def __init__(self, max_mb):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
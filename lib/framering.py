@@ -0,0 +1,123 @@
+from multiprocessing import shared_memory
+import threading
+import numpy as np
+
+# Slot states, a slot is READING from the moment a consumer takes it until every holder has released it
+SLOT_FREE = 0
+SLOT_WRITING = 1
+SLOT_READY = 2
+SLOT_READING = 3
+
+
+# Fixed set of frame slots in one shared memory block, passed from the capture to the decoders without copying.
+# The producer claims a free slot, fills it and commits it, which stamps it with the next write sequence number.
+# Consumers take ready slots in sequence order and release them when done, other processes can attach to the same
+# block and read a slot by its number. When every slot is in use the producer waits, or with drop_oldest reuses
+# the oldest slot no consumer has taken yet, the consumer then sees a gap in the sequence numbers.
+class FrameRing:
+
+    def __init__(self, size, frame_shape, drop_oldest=False):
+        self.size = size
+        self.frame_shape = frame_shape
+        self.drop_oldest = drop_oldest
+        self.buffer = shared_memory.SharedMemory(create=True, size=size * int(np.prod(frame_shape)))
+        self.frames = list(np.ndarray((size,) + tuple(frame_shape), dtype=np.uint8, buffer=self.buffer.buf))
+        self.name = self.buffer.name
+
+        self.states = [SLOT_FREE] * size
+        self.sequences = [0] * size
+        self.holders = [0] * size
+        self.write_seq = 0
+        self.dropped = 0
+        # Claims that found every slot in use, the producer got ahead of the consumers and had to wait or drop a frame
+        self.full = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def claim(self):
+        # (slot, frame) for the producer to write the next frame into
+        with self.condition:
+            if SLOT_FREE not in self.states:
+                self.full += 1
+            while True:
+                if SLOT_FREE in self.states:
+                    slot = self.states.index(SLOT_FREE)
+                    break
+                ready = self.__oldest(SLOT_READY)
+                if self.drop_oldest and ready is not None:
+                    slot = ready
+                    self.dropped += 1
+                    break
+                self.condition.wait()
+            self.states[slot] = SLOT_WRITING
+            return slot, self.frames[slot]
+
+    def commit(self, slot):
+        with self.condition:
+            self.sequences[slot] = self.write_seq
+            self.write_seq += 1
+            self.states[slot] = SLOT_READY
+            self.condition.notify_all()
+
+    def cancel(self, slot):
+        # Give back a claimed slot that was never filled
+        with self.condition:
+            self.states[slot] = SLOT_FREE
+            self.condition.notify_all()
+
+    def take(self):
+        # (sequence, slot) of the oldest ready frame, waits for one, None once the ring is closed and empty.
+        # The caller holds the slot until it calls release
+        with self.condition:
+            while True:
+                slot = self.__oldest(SLOT_READY)
+                if slot is not None:
+                    break
+                if self.closed:
+                    return None
+                self.condition.wait()
+            self.states[slot] = SLOT_READING
+            self.holders[slot] = 1
+            return self.sequences[slot], slot
+
+    def hold(self, slot):
+        # Keep a taken slot from being reused until one more release, e.g. to keep showing it after decoding
+        with self.condition:
+            self.holders[slot] += 1
+
+    def release(self, slot):
+        with self.condition:
+            self.holders[slot] -= 1
+            if self.holders[slot] <= 0:
+                self.holders[slot] = 0
+                self.states[slot] = SLOT_FREE
+                self.condition.notify_all()
+
+    def backlog(self):
+        # Frames committed but not taken yet
+        with self.condition:
+            return self.states.count(SLOT_READY)
+
+    def close(self):
+        # No more frames will be committed, take returns None once the rest are taken
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def unlink(self):
+        self.frames = []
+        self.buffer.close()
+        self.buffer.unlink()
+
+    def __oldest(self, state):
+        slots = [slot for slot in range(self.size) if self.states[slot] == state]
+        if len(slots) == 0:
+            return None
+        return min(slots, key=lambda slot: self.sequences[slot])
+
+
+def attach_frames(name, size, frame_shape):
+    # Frames of a FrameRing created in another process, keep the returned SharedMemory open while they are used
+    buffer = shared_memory.SharedMemory(name=name)
+    frames = list(np.ndarray((size,) + tuple(frame_shape), dtype=np.uint8, buffer=buffer.buf))
+    return buffer, frames
@@ -1,5 +1,6 @@
 import sys
 import threading, queue
+import collections
 import time
 import multiprocessing
 from enum import Enum
@@ -14,6 +15,54 @@ from .config import Config
 
 config = Config()
 
+# one byte for channel, one byte for flags, two bytes for ack, two bytes for seq, and the rest for binary_data
+HEADER_LENGTH = 6
+
+# Seq and ack numbers keep counting up without limit, only their low SEQ_BITS bits go on the wire as serial numbers (RFC 1982).
+# The receiving side expands them back to the full number closest to one it already knows, which is right as long as the
+# two are less than half the serial space apart, far more packets than are ever in flight
+SEQ_BITS = 16
+SEQ_MODULUS = 1 << SEQ_BITS
+
+# SACK bitmaps put on data packets that have room for them cover at most this many bytes (8 seq numbers each) past the ack,
+# MAINT packets carry as much as fits
+SACK_PIGGYBACK_BYTES = 4
+# A gap the peer hasn't been told about yet is reported right away, but no more than once every SACK_MIN_INTERVAL seconds,
+# and again every RTO while it stays open
+SACK_MIN_INTERVAL = 1
+# An ack that hasn't gone out with a data packet after ACK_DELAY seconds is sent on its own in a MAINT packet
+ACK_DELAY = 1
+
+# Retransmission timeout in seconds (RFC 6298). Relays add anywhere from 3 to over 20 seconds, so it starts high until the
+# handshake or the first ack gives a measurement
+INITIAL_RTO = 15
+MIN_RTO = 2
+MAX_RTO = 120
+# Smallest margin kept over the smoothed RTT, about one frame at the usual send_fps
+RTO_GRANULARITY = 1
+# Handshake gives up after this many seconds
+HANDSHAKE_TIMEOUT = 60
+
+# File packets allowed in flight, the window starts at INITIAL_WINDOW until acks give a throughput measurement and is kept at
+# WINDOW_GAIN times what the acked throughput delivers in one RTT. The throughput is the highest of the last RATE_SAMPLES
+# measurements, so while the link has room a full window doubles every RTT, and once it is full the extra stays queued
+INITIAL_WINDOW = 4
+MIN_WINDOW = 4
+MAX_WINDOW = 256
+WINDOW_GAIN = 2
+RATE_SAMPLES = 10
+
+# Every FEEDBACK_INTERVAL seconds each peer reports how the frames it captured decoded, and the other side adjusts its
+# send_fps (AIMD). More than RATE_LOSS_TARGET of the frames failing their CRC, or more than RATE_BEHIND_LIMIT frames
+# captured while the decoder was behind, multiplies it by RATE_DECREASE, otherwise it goes up by RATE_INCREASE frames per second.
+# Reports of fewer than RATE_MIN_FRAMES frames are too noisy to act on
+FEEDBACK_INTERVAL = 5
+RATE_LOSS_TARGET = 0.1
+RATE_BEHIND_LIMIT = 2
+RATE_INCREASE = 0.25
+RATE_DECREASE = 0.75
+RATE_MIN_FRAMES = 5
+
 class PeerConnection:
 
     def __init__(self, videoStream, shared_input, msg, args):
@@ -28,14 +77,43 @@ class PeerConnection:
         self.ack = LockVar({1:1, 2:1})
         self.peer_ack = LockVar({1:0, 2:0})
         self.resend = LockVar({1:list(),2:list()})
-        self.missing = LockVar({1:set(),2:set()})
-        self.send_buffer = LockVar({1:Buffer(1), 2:Buffer(2, 50)})
+        # [last send time, times sent] of every packet not acked by the peer yet, guarded by the resend lock. The time is set when
+        # the packet is queued on the video stream and again when the frame carrying it goes out
+        self.transmissions = {1:{}, 2:{}}
+        self.rtt = {1:RttEstimator(), 2:RttEstimator()}
+        # Last ack the peer was sent for each channel, in a data packet header or a MAINT packet, guarded by the ack lock
+        self.ack_sent = {1:1, 2:1}
+        self.send_buffer = LockVar({1:Buffer(1), 2:Buffer(2)})
+        # Queueing file packets blocks until the window has room, text messages are short and never wait
+        self.send_window = {2:SendWindow()}
+        # send_fps moves between min_send_fps and max_send_fps with the peer's decode reports, without max_send_fps it
+        # never goes above the configured send_fps. Keep it under the peer's recv_fps, frames the peer never captures
+        # don't show up in its reports as CRC failures
+        self.rate_control = None
+        if config.VIDEO_STREAM_PARAMS.get("rate_control", True):
+            self.rate_control = RateController(config.VIDEO_STREAM_PARAMS.get("min_send_fps", 0.25),
+                                               config.VIDEO_STREAM_PARAMS.get("max_send_fps", self.videoStream.send_fps))
+        # recv_valid, recv_crc_fail and recv_behind at the last decode report
+        self.feedback_totals = (0, 0, 0)
+        # Kinds of MAINT packet waiting in the video stream's queue, the decode report (0) and each channel's ack (1, 2). No other
+        # of the same kind is queued until that one goes out, so at a low send_fps control packets can't pile up ahead of the data
+        self.maint_queued = LockVar(set())
+        self.feedback_timer = time.time() + FEEDBACK_INTERVAL
         self.resend_queue = LockVar({1:queue.Queue(), 2:queue.Queue()})
         self.recv_buffer = LockVar({1:{}, 2:{}})
         self.channel_status = LockVar({1:[Status.NONE,None], 2:[Status.NONE,None]})
         self.buffer_threads = {}
         self.retries = 30
-        self.mtu = config.VIDEO_STREAM_PARAMS["mtu"]
+        self.videoStream.sent_callback = self.__packet_sent
+
+    @property
+    def mtu(self):
+        # Sized from what the codec can carry, a configured mtu above 0 only lowers it
+        mtu = self.videoStream.get_payload_capacity() - HEADER_LENGTH
+        max_mtu = config.VIDEO_STREAM_PARAMS.get("mtu", 0)
+        if max_mtu > 0:
+            mtu = min(mtu, max_mtu)
+        return mtu
 
     def initrecv(self):
         self.videoStream.initRecv()
@@ -72,6 +150,9 @@ class PeerConnection:
     def __check_handshake_flags(self, flags):
         self.msg.print(self.conn_status.get())
         if self.conn_status.get() == Status.NONE and Flags.is_only_set(flags,Flags.SYN):
+            if self.mtu <= 0:
+                self.msg.print("Refusing connection, the codec params leave no room for data after the packet headers")
+                return
             self.__setConnStatus(Status.SYN_RECV)
             connectThread = threading.Thread(target=self.__connect, name="ServerConnect")
             connectThread.start()
@@ -99,6 +180,10 @@ class PeerConnection:
         if self.recvStreamUp() == False:
             self.msg.print("Cannot connect, no recv stream")
             return
+
+        if self.mtu <= 0:
+            self.msg.print("Cannot connect, the codec params leave no room for data after the packet headers")
+            return
         
         threading.Thread(target=self.__connect, name="ClientConnect").start()
 
@@ -109,39 +194,20 @@ class PeerConnection:
             self.msg.print("BEGIN HANDSHAKE")
             
             # Send SYN flag, wait for SYN ACK
-            bin_flag = Flags.get_bin(Flags.SYN)
-            self.__send_control_message(bin_flag)
             self.__setConnStatus(Status.SYN_SEND)
-            
-            for attempt in range(self.retries):
-                if self.conn_status.get() == Status.SYN_ACK_RECV:
-                    bin_flag = Flags.get_bin(Flags.ACK)
-                    self.__send_control_message(bin_flag)
-                    self.__setConnStatus(Status.ACK_SEND)
-                    self.__setConnStatus(Status.CONNECTED)
-                    break
-                if attempt == self.retries -1:
-                    self.conn_status = Status.NONE
-                    self.msg.print("Connect has timed out!")
-                    return
-
-                time.sleep(2)
+            if not self.__handshake(Flags.get_bin(Flags.SYN), Status.SYN_ACK_RECV):
+                return
+            bin_flag = Flags.get_bin(Flags.ACK)
+            self.__send_control_message(bin_flag)
+            self.__setConnStatus(Status.ACK_SEND)
+            self.__setConnStatus(Status.CONNECTED)
 
         # This path is followed if a SYN flag was received to initialize a connection
         elif self.conn_status.get() == Status.SYN_RECV:
-            bin_flag = Flags.get_bin((Flags.SYN, Flags.ACK))
-            self.__send_control_message(bin_flag)
-            # Mark as connected??
             self.__setConnStatus(Status.SYN_ACK_SEND)
-            for attempt in range(self.retries):
-                if self.conn_status.get() == Status.ACK_RECV:
-                    self.__setConnStatus(Status.CONNECTED)
-                    break
-                if attempt == self.retries - 1:
-                    self.conn_status = Status.NONE
-                    self.msg.print("Connect has timed out!")
-                    return
-                time.sleep(2)
+            if not self.__handshake(Flags.get_bin((Flags.SYN, Flags.ACK)), Status.ACK_RECV):
+                return
+            self.__setConnStatus(Status.CONNECTED)
 
 
         # Connected, start all buffer threads to handle in/out packets
@@ -155,6 +221,34 @@ class PeerConnection:
             
 
 
+    def __handshake(self, bin_flag, reply_status):
+        # Send a handshake packet and wait for the peer's reply, sent again every RTO (doubling) until it comes or the handshake times out.
+        # The time to the reply is the first RTT measurement for both channels, unless the packet had to be sent again (Karn)
+        rto = INITIAL_RTO
+        start = time.time()
+        sent_time = start
+        sent_count = 1
+        self.__send_control_message(bin_flag)
+        while self.conn_status.get() != reply_status:
+            now = time.time()
+            if now - start > HANDSHAKE_TIMEOUT:
+                self.__setConnStatus(Status.NONE)
+                self.msg.print("Connect has timed out!")
+                return False
+            if now - sent_time >= rto:
+                self.msg.print("No handshake reply after "+str(rto)+"s, sending again",1)
+                self.__send_control_message(bin_flag)
+                rto = min(MAX_RTO, rto * 2)
+                sent_time = now
+                sent_count += 1
+            time.sleep(.1)
+
+        if sent_count == 1:
+            for channel in (1,2):
+                if self.rtt[channel].srtt is None:
+                    self.rtt[channel].sample(time.time() - sent_time)
+        return True
+
     ## ============================================================================================================================
     ## Recv messages methods
     ## ============================================================================================================================
@@ -163,8 +257,6 @@ class PeerConnection:
 
     def __recvMessagesWorker(self):
 
-        # one byte for channel, one byte for flags, two bytes for ack, two bytes for seq, and the rest for binary_data
-        header_length = 6
         # For now, add some time to avoid reading images from previous session
         
         time.sleep(1)
@@ -181,7 +273,7 @@ class PeerConnection:
             if len(raw_message) == 0:
                 continue
 
-            format_string = '>BBHH{}s'.format(len(raw_message)-header_length)
+            format_string = '>BBHH{}s'.format(len(raw_message)-HEADER_LENGTH)
 
             try:
             # Unpack binary data into headers and data
@@ -193,8 +285,23 @@ class PeerConnection:
                 self.msg.print("Raw Message: "+str(raw_message),1)
                 self.msg.print("Length: "+str(len(raw_message)),1)
                 continue
-            with self.peer_ack.lock:
-                self.peer_ack.var[channel] = ack
+            if channel in (1,2):
+                with self.ack.lock:
+                    seq = expand_serial(seq, self.ack.var[channel])
+                with self.peer_ack.lock:
+                    ack = expand_serial(ack, self.peer_ack.var[channel])
+            if channel > 0 and self.conn_status.get() == Status.CONNECTED:
+                self.__process_ack(channel, ack)
+
+            # The peer's SACK bitmap for this channel, strip it and the flag so the rest sees a plain data packet
+            if channel > 0 and Flags.is_set(flags, Flags.SACK):
+                if len(data) < 1 or len(data) < 1 + data[0]:
+                    self.msg.print("SACK bitmap is longer than the packet, dropped",1)
+                    continue
+                bitmap, data = data[1:1 + data[0]], data[1 + data[0]:]
+                flags = (flags[0] & ~Flags.get_int(Flags.SACK)).to_bytes(1, byteorder='big')
+                if self.conn_status.get() == Status.CONNECTED:
+                    self.__process_sack(channel, ack, bitmap)
 
             # Channel 0 is used for establishing a connection
             if channel == 0 and self.conn_status.get() != Status.CONNECTED:
@@ -204,34 +311,44 @@ class PeerConnection:
             if self.conn_status.get() != Status.CONNECTED:
                 continue
 
-            # If any resends are requested with the maintenance packet, they will be processed by the send buffer thread
-            if channel == 0 and Flags.is_set(flags,Flags.MAINT):
-                with self.resend.lock:
-                    # format_string = '>BH{}i'.format((len(data) - 1) // 4)
-                    format_string = '>BH{}i'.format((len(data) - 1) // struct.calcsize('i'))
-                    channel, ack, *resend_list = struct.unpack(format_string, data)
-                    with self.peer_ack.lock:
-                        self.peer_ack.var[channel] =  ack
-                    if len(resend_list) > 0:
-                        self.msg.print ("Got MAINT packet with resends - channel: "+str(channel)+", ack "+str(ack)+" resend: "+str(resend_list),1)
-                    else:
-                        self.msg.print ("Got MAINT packet channel: "+str(channel)+", ack "+str(ack)+" no resends",1)
-                    if not resend_list:  # Check if resend_list is empty
-                        resend_list = []  # Assign an empty list if it's empty
-                    elif isinstance(resend_list, int):
-                        resend_list = [resend_list]  # Convert to a list if it's a single integer
-
-                    self.resend.var[channel] = resend_list
-
-                
-                # If the ack specified is less than the current syn, it means the peer never received that, but may not know it was sent. Resend it
-                with self.ack.lock,  self.seq.lock, self.resend.lock:
-                    last_seq = self.seq.var[channel]-1
+            # Our handshake ACK was lost, the peer is still sending SYN ACK
+            if channel == 0 and Flags.is_set(flags, (Flags.SYN, Flags.ACK)):
+                self.__send_control_message(Flags.get_bin(Flags.ACK))
+                continue
 
-                    if ack <= last_seq and len(self.resend.var[channel]) == 0:
-                        # Could resend everything from ack to seq incase they missed multiple
-                        self.resend.var[channel].append(last_seq)
+            # The peer's decode report, MAINT with MOD so it isn't taken for an ack
+            if channel == 0 and Flags.is_set(flags, (Flags.MAINT, Flags.MOD)):
+                try:
+                    valid, crc_fail, behind = struct.unpack('>HHH', data[:6])
+                except struct.error:
+                    self.msg.print("Error unpacking decode report: "+str(data),1)
+                    continue
+                self.msg.print("Got decode report, valid: "+str(valid)+", crc fail: "+str(crc_fail)+", behind: "+str(behind),1)
+                if self.rate_control is not None:
+                    change = self.rate_control.report(self.videoStream.send_fps, valid, crc_fail, behind)
+                    if change is not None:
+                        self.videoStream.set_send_fps(*change)
+                continue
 
+            # The maintenance packet holds the peer's ack and SACK bitmap for a channel, resends are processed by the send buffer thread
+            if channel == 0 and Flags.is_set(flags,Flags.MAINT):
+                try:
+                    channel, ack = struct.unpack('>BH', data[:3])
+                except struct.error:
+                    self.msg.print("Error unpacking MAINT packet: "+str(data),1)
+                    continue
+                if channel not in (1,2):
+                    self.msg.print("MAINT packet for unknown channel: "+str(channel),1)
+                    continue
+                with self.peer_ack.lock:
+                    ack = expand_serial(ack, self.peer_ack.var[channel])
+                bitmap = data[3:]
+                missing = self.__process_sack(channel, ack, bitmap)
+                if len(missing) > 0:
+                    self.msg.print ("Got MAINT packet with resends - channel: "+str(channel)+", ack "+str(ack)+" missing: "+str(missing),1)
+                else:
+                    self.msg.print ("Got MAINT packet channel: "+str(channel)+", ack "+str(ack)+" no resends",1)
+                # A lost last packet shows up as neither acked nor missing, the retransmit timer resends it
                 continue
             
             # This should not happen, but I'd like to know if it does
@@ -255,6 +372,9 @@ class PeerConnection:
                         self.msg.print("Added "+str(seq)+" to buffer.",1)
             elif channel > 0 and seq < self.ack.get()[channel]:
                 self.msg.print("Packet "+str(seq)+" arrived but is not needed, not added to buffer.",1)
+                # The peer resent it, so the ack it was sent got lost, have it sent again
+                with self.ack.lock:
+                    self.ack_sent[channel] = min(self.ack_sent[channel], seq)
 
 
 
@@ -266,6 +386,11 @@ class PeerConnection:
 
         maint_interval = 30
         maint_timer = time.time()+maint_interval
+        # Missing seqs the peer has been told about, and when the last SACK went out
+        reported = set()
+        sack_time = 0
+        # Since when the ack has been ahead of what the peer was last sent
+        ack_pending_time = None
 
         while True:
             purge_buffer = False
@@ -280,14 +405,8 @@ class PeerConnection:
                         self.msg.print(str(seq)+" is less than "+str(self.ack.var[channel]),1)
                         continue
 
-                    # If out of order, add seq numbers in the gap to the resend set and continue to next
+                    # Out of order, the gap before it is reported with the SACK bitmap below
                     if seq > self.ack.var[channel]:
-                       # print(str(seq)+" is greater than "+str(self.ack.var[channel]))
-                        with self.missing.lock:
-                          #  missing_set = set([seq - i for i in range(1, seq - self.ack.var[channel])])
-                            missing_set = set([seq - i for i in range(0, seq - self.ack.var[channel] + 1)])
-                            missing_set -= set(buffered_seq)
-                            self.missing.var[channel].update(missing_set)
                         continue
                     
                     # If not out of order, update the ack and continue processing the data
@@ -339,22 +458,29 @@ class PeerConnection:
             time.sleep(.15)
 
 
-            if maint_timer < time.time():
-                # check for resends and process
-                missing_list = []
-                with self.missing.lock, self.ack.lock:
-                    binary_data = struct.pack('>BH', channel, self.ack.var[channel])
-                    if len(self.missing.var[channel]) > 0:
-                        # Make sure all missing seq #s are greater than the ack
-                        missing_list = [x for x in list(self.missing.var[channel]) if x >= self.ack.var[channel]]
-                        if len(missing_list) > 0:
-                            # Channel + List of missing syn #s
-                            binary_data += struct.pack('>{}i'.format(len(missing_list)), *missing_list)
-                            self.missing.var[channel] = set()                    
-                    self.msg.print("Sending MAINT packet for channel:"+str(channel)+", ack "+str(self.ack.var[channel])+", missing_list: "+str(missing_list),1)
-                    self.__send_control_message(Flags.get_bin(Flags.MAINT),binary_data)
+            # Report gaps as soon as they show up instead of waiting for the next MAINT, rate limited
+            ack, bitmap = self.__get_sack(channel)
+            missing = set(get_sack_missing(ack, bitmap))
+            reported &= missing
+            now = time.time()
+            # The peer's RTT measurements depend on acks coming back soon, not only when there is data going its way
+            with self.ack.lock:
+                ack_pending = self.ack_sent[channel] < ack
+            if not ack_pending:
+                ack_pending_time = None
+            elif ack_pending_time is None:
+                ack_pending_time = now
+            maint_due = ((missing - reported and now - sack_time >= SACK_MIN_INTERVAL) or (missing and now - sack_time >= self.rtt[channel].rto)
+                    or (ack_pending_time is not None and now - ack_pending_time >= ACK_DELAY) or maint_timer < now)
+            if maint_due and self.__queue_maint(channel, Flags.get_bin(Flags.MAINT), struct.pack('>BH', channel, ack % SEQ_MODULUS) + bitmap):
+                self.msg.print("Sending MAINT packet for channel:"+str(channel)+", ack "+str(ack)+", missing: "+str(sorted(missing)),1)
+                with self.ack.lock:
+                    self.ack_sent[channel] = max(self.ack_sent[channel], ack)
+                reported |= missing
+                sack_time = now
+                ack_pending_time = None
                 # reset timer
-                maint_timer = time.time()+maint_interval
+                maint_timer = now+maint_interval
 
 
             # Clear buffer for this channel up to the ack number, thank ChatGPT for the one-liner
@@ -411,7 +537,9 @@ class PeerConnection:
             # Resend back an ACK packet with the file ID
             bin_flags = Flags.get_bin(Flags.ACK)                           
             file_binary_data = struct.pack(f'!HQ', file_id, size)
-            self.__queue_message(file_binary_data, channel, bin_flags)
+            # This runs with the recv buffer and ack locks held, which acks need to free room in the send window,
+            # so the ACK is queued from a thread of its own in case it has to wait for room
+            threading.Thread(target=self.__queue_message, args=(file_binary_data, channel, bin_flags), name="FileAckThread").start()
             self.set_channel_status(channel,Status.FILE_RECV)
 
         return incoming_file
@@ -454,41 +582,72 @@ class PeerConnection:
             # channel = 1
             
 
+            # The window limits channel 2 as packets are queued, everything queued can go out
             self.__process_channel_send_buffer(1)
-            self.__process_channel_send_buffer(2,2)
+            self.__process_channel_send_buffer(2)
 
             for channel in (1,2):
                 # Purge buffer up until last_ack by peer
                 with self.peer_ack.lock, self.send_buffer.lock:
                     self.send_buffer.var[channel].purge_buffer(self.peer_ack.var[channel])
+                self.__check_retransmit_timer(channel)
+
+            if time.time() >= self.feedback_timer and self.__send_decode_report():
+                self.feedback_timer = time.time() + FEEDBACK_INTERVAL
                     
             time.sleep(.25)
 
+    def __send_decode_report(self):
+        # How the frames captured since the last report decoded and how many found the decoder behind, for the peer's rate control
+        with self.videoStream.stats.lock:
+            stats = self.videoStream.stats.var
+            totals = (stats.recv_valid, stats.recv_crc_fail, stats.recv_behind)
+        counts = [min(0xFFFF, total - last) for total, last in zip(totals, self.feedback_totals)]
+        if not self.__queue_maint(0, Flags.get_bin((Flags.MAINT, Flags.MOD)), struct.pack('>HHH', *counts)):
+            return False
+        self.feedback_totals = totals
+        return True
 
-    def __process_channel_send_buffer(self, channel, max_items=sys.maxsize):
+
+    def __process_channel_send_buffer(self, channel):
         channel_q = self.send_buffer.var[channel].queue
         count = 0
 
-        while not channel_q.empty() and count < max_items:
+        while not channel_q.empty():
             message, seq, bin_flags = channel_q.get()
-            with self.seq.lock, self.ack.lock:
-                data = channel.to_bytes(1, byteorder='big')+bin_flags + self.ack.var[channel].to_bytes(2, byteorder='big') + seq.to_bytes(2, byteorder='big') + message
-            # videoStream will queue sending, one goes out every 2 seconds
-            self.videoStream.send(data)
+            ack, bitmap = self.__get_sack(channel, SACK_PIGGYBACK_BYTES)
+            # Piggyback the SACK bitmap when there is a gap and the packet has room for it
+            if bitmap and len(message) + 1 + len(bitmap) <= self.videoStream.get_payload_capacity() - HEADER_LENGTH:
+                bin_flags = Flags.get_bin(Flags.SACK, bin_flags)
+                message = len(bitmap).to_bytes(1, byteorder='big') + bitmap + message
+            data = channel.to_bytes(1, byteorder='big')+bin_flags + get_serial_bytes(ack) + get_serial_bytes(seq) + message
+            # Registered before it is queued, so the packet going out or an ack for it always finds the entry
+            with self.resend.lock:
+                self.transmissions[channel][seq] = [time.time(), 1]
+            # videoStream will queue sending, frames go out at send_fps
+            self.videoStream.send(data, get_cache_key(data))
+            with self.ack.lock:
+                self.ack_sent[channel] = max(self.ack_sent[channel], ack)
             self.msg.print("Channel "+str(channel)+" queued "+str(seq),1)
             count+=1
 
-        # Send out any requested missing packets and empty the resend list
+        # Send out any requested missing packets and empty the resend list, with the current ack in place of the buffered one
         resend_count = 0
+        ack = self.__get_sack(channel, 0)[0]
 
         with self.resend.lock, self.peer_ack.lock:
             if len(self.resend.var[channel]) > 0:
                 for syn in self.resend.var[channel]:
                     if syn < self.peer_ack.var[channel]:
                         continue
-                    #print(self.send_buffer.var[channel].buffer)
-                    buffer_data = self.send_buffer.var[channel].buffer[syn]
-                    self.videoStream.send(buffer_data)
+                    buffer_data = self.send_buffer.var[channel].buffer.get(syn)
+                    transmission = self.transmissions[channel].get(syn)
+                    # A SACK may have acked it since it was asked for
+                    if buffer_data is None or transmission is None:
+                        continue
+                    transmission[0] = time.time()
+                    transmission[1] += 1
+                    self.videoStream.send(buffer_data[:2] + get_serial_bytes(ack) + buffer_data[4:], get_cache_key(buffer_data))
                     self.msg.print("Channel "+str(channel)+" queued resend "+str(syn),1)
                     resend_count+=1
 
@@ -583,9 +742,97 @@ class PeerConnection:
                         bin_flags = Flags.get_bin((Flags.SYN, Flags.MOD))
                         # Middle of segment
                     
+                    # Waits for room in the send window, so chunks go out as fast as the peer acks them
                     self.__queue_message(chunk, channel, bin_flags)
 
-                    time.sleep(2)
+    def __get_sack(self, channel, max_bytes=None):
+        # (ack, SACK bitmap) of what has been received on the channel, the bitmap is empty when nothing is missing
+        if max_bytes is None:
+            max_bytes = max(0, self.mtu - 3)
+        with self.recv_buffer.lock, self.ack.lock:
+            # Packets already buffered but not processed yet have arrived, they must not show up as missing
+            ack = self.ack.var[channel]
+            while ack in self.recv_buffer.var[channel]:
+                ack += 1
+            return ack, get_sack_bitmap(ack, self.recv_buffer.var[channel], max_bytes)
+
+    def __process_sack(self, channel, ack, bitmap):
+        # Queue resends of the packets the peer's SACK bitmap shows are missing, returns them
+        missing = get_sack_missing(ack, bitmap)
+        self.__process_ack(channel, ack, get_sack_received(ack, bitmap))
+        with self.seq.lock, self.resend.lock:
+            last_seq = self.seq.var[channel]-1
+            for seq in missing:
+                if seq <= last_seq:
+                    self.__queue_resend(channel, seq)
+        return missing
+
+    def __queue_resend(self, channel, seq):
+        # Called with the resend lock held. Frames arrive in order, so a packet reported missing was lost and is resent right away,
+        # but a resend isn't sent again within an RTO, it may still be on its way. Backoff only slows the timer, not this
+        transmission = self.transmissions[channel].get(seq)
+        if transmission is not None and transmission[1] > 1 and time.time() - transmission[0] < self.rtt[channel].base_rto:
+            return
+        if seq not in self.resend.var[channel]:
+            self.resend.var[channel].append(seq)
+
+    def __packet_sent(self, data):
+        # Called by the video stream when a packet goes out, RTTs and timeouts are measured from here
+        if len(data) > HEADER_LENGTH and data[0] == 0 and Flags.is_set(data[1], Flags.MAINT):
+            kind = 0 if Flags.is_set(data[1], Flags.MOD) else data[HEADER_LENGTH]
+            with self.maint_queued.lock:
+                self.maint_queued.var.discard(kind)
+            return
+        if len(data) < HEADER_LENGTH or data[0] not in (1,2):
+            return
+        channel, flags, ack, seq = struct.unpack('>BBHH', data[:HEADER_LENGTH])
+        with self.resend.lock, self.peer_ack.lock:
+            transmission = self.transmissions[channel].get(expand_serial(seq, self.peer_ack.var[channel]))
+            if transmission is not None:
+                transmission[0] = time.time()
+
+    def __process_ack(self, channel, ack, received=()):
+        # Every packet before the ack has arrived, as have the ones in received (from a SACK bitmap). The first time a packet
+        # shows up as arrived it gives an RTT measurement, unless it was sent more than once (Karn's algorithm). Nor does anything
+        # acked along with a resend, those waited on the resend before the peer could ack them
+        now = time.time()
+        with self.resend.lock, self.peer_ack.lock:
+            # Acks are the next seq the peer expects, seqs start at 1
+            advance = max(0, ack - max(self.peer_ack.var[channel], 1))
+            self.peer_ack.var[channel] = max(self.peer_ack.var[channel], ack)
+            acked = [seq for seq in self.transmissions[channel] if seq < self.peer_ack.var[channel] or seq in received]
+            sample = None
+            resent = False
+            for seq in acked:
+                sent_time, sent_count = self.transmissions[channel].pop(seq)
+                resent = resent or sent_count > 1
+                if sent_count == 1:
+                    sample = now - sent_time if sample is None else min(sample, now - sent_time)
+            if resent:
+                sample = None
+            if sample is not None:
+                self.rtt[channel].sample(sample)
+            elif advance > 0:
+                # New data got through, so the link is back even without a measurement
+                self.rtt[channel].reset_backoff()
+        # Outside the locks, the window's condition is held by senders waiting for room. Packets the SACK shows have arrived
+        # leave the window too, so it keeps moving while a lost one is sent again
+        if len(acked) > 0 and channel in self.send_window:
+            self.send_window[channel].acked(acked, self.rtt[channel].srtt, resent)
+
+    def __check_retransmit_timer(self, channel):
+        # Resend the oldest packet the peer hasn't acked once it has gone an RTO without one, and double the RTO until an ack comes.
+        # SACKs take care of any others that were lost
+        with self.resend.lock:
+            if len(self.transmissions[channel]) == 0:
+                return
+            seq = min(self.transmissions[channel])
+            sent_time = self.transmissions[channel][seq][0]
+            if time.time() - sent_time < self.rtt[channel].rto or seq in self.resend.var[channel]:
+                return
+            self.msg.print("Channel "+str(channel)+" retransmit timeout for "+str(seq)+" after "+str(round(self.rtt[channel].rto, 1))+"s",1)
+            self.rtt[channel].backoff()
+            self.resend.var[channel].append(seq)
 
     # When messages are queued:
     # - Add to buffer
@@ -596,17 +843,26 @@ class PeerConnection:
         if bin_flags is None:
             bin_flags = Flags.get_bin(Flags.NONE)
 
-
-        while True:
-            with self.send_buffer.lock:
-                result = self.send_buffer.var[channel].add(binary_data, self.seq.var[channel], bin_flags)
-                if result:
-                    with self.seq.lock:
-                        self.seq.var[channel] += 1
-                    break
-            self.msg.print("Buffer full, waiting for acks from peer...",1)
-            time.sleep(2)
-
+        if channel in self.send_window:
+            self.send_window[channel].acquire()
+
+        with self.send_buffer.lock:
+            with self.seq.lock:
+                seq = self.seq.var[channel]
+                self.seq.var[channel] += 1
+            if channel in self.send_window:
+                self.send_window[channel].add(seq)
+            self.send_buffer.var[channel].add(binary_data, seq, bin_flags)
+
+
+    def __queue_maint(self, kind, bin_flag, message):
+        # False when a MAINT packet of this kind is still waiting to go out, see maint_queued
+        with self.maint_queued.lock:
+            if kind in self.maint_queued.var:
+                return False
+            self.maint_queued.var.add(kind)
+        self.__send_control_message(bin_flag, message)
+        return True
 
     # Control messages always on channel 1, are not buffered
     def __send_control_message(self, bin_flag, message=None):
@@ -641,6 +897,10 @@ class PeerConnection:
         self.msg.print("conn_status: "+str(self.conn_status.get()))
         self.msg.print("seq: "+str(self.seq.get()))
         self.msg.print("ack: "+str(self.ack.get()))
+        for channel in (1,2):
+            self.msg.print("rtt "+str(channel)+": "+str(self.rtt[channel]))
+        for channel in self.send_window:
+            self.msg.print("send_window "+str(channel)+": "+str(self.send_window[channel]))
         self.msg.print("send_buffer: "+"1: "+str(self.send_buffer.var[1].queue.qsize())+" 2: "+str(self.send_buffer.var[2].queue.qsize()))
         self.msg.print("recv_buffer: "+"1: "+str(len(self.recv_buffer.get()[1]))+" 2: "+str(len(self.recv_buffer.get()[2])))
         self.msg.print("recv image backlog: "+str(video_stream_stats.recv_backlog))
@@ -678,6 +938,180 @@ class PeerConnection:
         return False
     
 
+def get_sack_bitmap(ack, received, max_bytes):
+    # Bit i, most significant bit first, is set if ack+1+i was received. Empty unless something past the ack was received,
+    # trailing zero bytes are left off
+    bits = [seq - ack - 1 for seq in received if ack < seq <= ack + max_bytes * 8]
+    if len(bits) == 0:
+        return b""
+    bitmap = bytearray(max(bits) // 8 + 1)
+    for bit in bits:
+        bitmap[bit // 8] |= 0x80 >> (bit % 8)
+    return bytes(bitmap)
+
+def get_cache_key(data):
+    # The packet without its ack, a resend carries whatever the ack is by then and should still find the first send's encoding
+    return data[:2] + data[4:]
+
+def get_serial_bytes(seq):
+    # The two bytes a seq or ack number goes on the wire as
+    return (seq % SEQ_MODULUS).to_bytes(2, byteorder='big')
+
+def serial_distance(a, b):
+    # a - b in serial number arithmetic, negative when a comes before b
+    return (a - b + SEQ_MODULUS // 2) % SEQ_MODULUS - SEQ_MODULUS // 2
+
+def expand_serial(serial, reference):
+    # The full seq number with serial as its low bits that is closest to reference
+    return reference + serial_distance(serial, reference % SEQ_MODULUS)
+
+def get_sack_received(ack, bitmap):
+    # Seq numbers past the ack a SACK bitmap shows were received
+    return [ack + 1 + bit for bit in range(len(bitmap) * 8) if bitmap[bit // 8] & (0x80 >> (bit % 8))]
+
+def get_sack_missing(ack, bitmap):
+    # Seq numbers a SACK bitmap shows are missing, the ack itself and every clear bit before the last set one
+    received = get_sack_received(ack, bitmap)
+    if len(received) == 0:
+        return []
+    return [ack] + sorted(set(range(ack + 1, received[-1])) - set(received))
+
+
+class RttEstimator:
+    # Smoothed round trip time and retransmission timeout of one channel as in RFC 6298, in seconds
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        # The RTO before any backoff, what a packet that arrived normally takes to be acked at most
+        self.base_rto = INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.reset_backoff()
+
+    def backoff(self):
+        self.rto = min(MAX_RTO, self.rto * 2)
+
+    def reset_backoff(self):
+        if self.srtt is not None:
+            self.base_rto = min(MAX_RTO, max(MIN_RTO, self.srtt + max(RTO_GRANULARITY, 4 * self.rttvar)))
+        self.rto = self.base_rto
+
+    def __str__(self):
+        srtt = "none" if self.srtt is None else str(round(self.srtt, 2))+"s"
+        return "srtt "+srtt+", rto "+str(round(self.rto, 2))+"s"
+
+
+class SendWindow:
+    # Packets of a channel allowed in flight, from being queued until the peer acks them. Senders wait on the condition for room
+
+    def __init__(self):
+        self.size = INITIAL_WINDOW
+        # Slots taken by acquire(), and the seqs of the packets holding them. Only a seq still in outstanding frees its slot
+        # when acked, a packet acked twice (a SACK and then the ack passing it) is only counted once
+        self.in_flight = 0
+        self.outstanding = set()
+        # Packets acked per second, measured over about one RTT each
+        self.rates = collections.deque(maxlen=RATE_SAMPLES)
+        self.interval_start = time.time()
+        self.interval_acked = 0
+        # Whether a sender waited for room during the current interval, and whether it waited on a resend
+        self.limited = False
+        self.recovering = False
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            # Time spent with nothing to send says nothing about the link
+            if self.in_flight == 0:
+                self.interval_start = time.time()
+                self.interval_acked = 0
+            while self.in_flight >= self.size:
+                self.limited = True
+                self.condition.wait()
+            self.in_flight += 1
+
+    def add(self, seq):
+        # The seq of the packet that took the slot from acquire()
+        with self.condition:
+            self.outstanding.add(seq)
+
+    def acked(self, seqs, srtt, resent=False):
+        # Measure the acked throughput over intervals of about one RTT and resize the window from it
+        with self.condition:
+            count = len(self.outstanding.intersection(seqs))
+            self.outstanding.difference_update(seqs)
+            self.in_flight = max(0, self.in_flight - count)
+            self.interval_acked += count
+            self.recovering = self.recovering or resent
+            now = time.time()
+            elapsed = now - self.interval_start
+            if srtt is not None and elapsed >= srtt:
+                self.rates.append(self.interval_acked / elapsed)
+                size = int(min(MAX_WINDOW, max(MIN_WINDOW, WINDOW_GAIN * max(self.rates) * srtt)))
+                # A sender that ran out of data acks less than the link can carry, as does one waiting for a lost frame to be sent
+                # again, which is no sign of the link being full. Only a full window without losses may shrink
+                self.size = size if self.limited and not self.recovering else max(self.size, size)
+                self.interval_start = now
+                self.interval_acked = 0
+                self.limited = self.in_flight >= self.size
+                self.recovering = False
+            self.condition.notify_all()
+
+    def __str__(self):
+        rate = "none" if len(self.rates) == 0 else str(round(max(self.rates), 2))+" packets/s"
+        return str(self.in_flight)+"/"+str(self.size)+" in flight, acked "+rate
+
+
+class RateController:
+    # AIMD on the sender's send_fps from the peer's decode reports, between min_fps and max_fps. Slowing down only pays when
+    # the losses come from going too fast, when the next report shows they didn't drop the old rate comes back and losses up
+    # to that level no longer count against the rate
+
+    def __init__(self, min_fps, max_fps):
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        # Loss the link has whatever the rate
+        self.baseline_loss = 0
+        # (fps, loss) before the last decrease for losses, until the next report shows whether it helped
+        self.last_decrease = None
+
+    def report(self, fps, valid, crc_fail, behind):
+        # (new fps, reason) when the report calls for a change, None otherwise
+        decoded = valid + crc_fail
+        if decoded < RATE_MIN_FRAMES:
+            return None
+        loss = crc_fail / decoded
+        last_decrease = self.last_decrease
+        self.last_decrease = None
+        if last_decrease is not None and loss > last_decrease[1] * RATE_DECREASE:
+            self.baseline_loss = loss
+            reason = "crc fail "+str(round(loss * 100))+"% at a lower rate too"
+            new_fps = last_decrease[0]
+        elif loss > self.baseline_loss + RATE_LOSS_TARGET:
+            reason = "crc fail "+str(round(loss * 100))+"%"
+            new_fps = fps * RATE_DECREASE
+            self.last_decrease = (fps, loss)
+        elif behind > RATE_BEHIND_LIMIT:
+            reason = "peer fell behind on "+str(behind)+" frames"
+            new_fps = fps * RATE_DECREASE
+        else:
+            self.baseline_loss = min(self.baseline_loss, loss)
+            reason = "crc fail "+str(round(loss * 100))+"%"
+            new_fps = fps + RATE_INCREASE
+        new_fps = round(min(self.max_fps, max(self.min_fps, new_fps)), 2)
+        if new_fps == fps:
+            return None
+        return new_fps, reason+", "+str(fps)+" -> "+str(new_fps)+" fps"
+
+
 class Status(Enum):
     NONE = 0
     SYN_SEND = 1
@@ -705,7 +1139,7 @@ class Buffer:
         if len(self.buffer) >= self.max_items:
             return False
         self.queue.put((bin_data, seq, bin_flags))
-        self.buffer[seq] = self.channel.to_bytes(1, byteorder='big')+bin_flags + self.no_ack.to_bytes(2, byteorder='big') + seq.to_bytes(2, byteorder='big') + bin_data
+        self.buffer[seq] = self.channel.to_bytes(1, byteorder='big')+bin_flags + get_serial_bytes(self.no_ack) + get_serial_bytes(seq) + bin_data
         return True
 
 
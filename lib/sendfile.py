@@ -29,6 +29,8 @@ class OutgoingFile(BaseFile):
 
 
     def get_file_chunks(self, chunk_size=25):
+        if chunk_size <= 0:
+            raise ValueError("chunk_size must be above 0, got "+str(chunk_size))
         start_flag = True
 
         segments = list(self.__get_file_segments())  # Store segments in a list
@@ -0,0 +1,133 @@
+# Microbenchmark for the rgb_grid codec
+#
+# Run from the project root:
+#   python3 -m lib.stegocodecs.benchmark
+import os
+import time
+import base64
+import numpy as np
+import cv2
+from . import rgb_grid
+
+GRID_SIZES = [(15, 12), (40, 35), (64, 48), (80, 60)]
+SOURCE_SIZES = [(854, 480), (1920, 1080)]
+ITERATIONS = 20
+
+
+class BenchmarkMessages:
+    def print(self, text, verbose=0):
+        pass
+
+
+def get_params(num_boxes_x, num_boxes_y):
+    return {
+        "width" : 1280,
+        "height" : 720,
+        "num_boxes_x" : num_boxes_x,
+        "num_boxes_y" : num_boxes_y,
+        "gap_size" : 2,
+        "box_reduction" : True
+    }
+
+
+def get_noisy_frame(codec, payload):
+    # Encoded frame with some noise added, similar to what comes back from a transcoded stream
+    image = codec.encode(payload)
+    noise = np.random.normal(0, 6, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def reference_decode(codec, raw_image):
+    # The original per-box decode loop, kept here to compare against
+    image = cv2.resize(raw_image, (codec.width, codec.height))
+    value_range_np = np.array(codec.map_range)
+    raw_data = ""
+
+    x_coords = np.arange(0, codec.num_boxes_x * codec.box_step_x - codec.gap_size, codec.box_step_x)
+    y_coords = np.arange(0, codec.num_boxes_y * codec.box_step_y - codec.gap_size, codec.box_step_y)
+
+    for x in x_coords:
+        for y in y_coords:
+            box = image[y + codec.box_reduction:y + codec.box_size_y - codec.box_reduction,
+                        x + codec.box_reduction:x + codec.box_size_x - codec.box_reduction]
+            rgb_np = np.array((np.mean(box[:, :, 0]), np.mean(box[:, :, 1]), np.mean(box[:, :, 2])))
+            r_value = value_range_np[np.argmin(np.abs(rgb_np[0] - value_range_np))]
+            g_value = value_range_np[np.argmin(np.abs(rgb_np[1] - value_range_np))]
+            b_value = value_range_np[np.argmin(np.abs(rgb_np[2] - value_range_np))]
+            if r_value == 255 and g_value == 255 and b_value == 255:
+                return raw_data
+            raw_data += codec.decode_map.get("(%d, %d, %d)" % (r_value, g_value, b_value), "")
+    return raw_data
+
+
+def reference_encode(codec, raw_data):
+    # The original per-character encode loop, kept here to compare against
+    base32_data = base64.b32encode(raw_data).decode('utf-8')
+    line = base32_data + rgb_grid.DELIMITER + codec._Codec__getCRC(base32_data)
+    grid = np.ones((codec.height, codec.width, 3), dtype=np.uint8)
+    grid[:codec.num_boxes_y * codec.box_step_y, :codec.num_boxes_x * codec.box_step_x, :] = codec.background_color
+    i = 0
+    j = 0
+
+    for c in line:
+        grid[j:j + codec.box_size_y, i:i + codec.box_size_x, :] = codec.encode_map[c]
+        j += codec.box_step_y
+        if j >= codec.num_boxes_y * codec.box_step_y:
+            j = 0
+            i += codec.box_step_x
+            if i >= codec.num_boxes_x * codec.box_step_x:
+                i = 0
+
+    return grid
+
+
+def time_call(func, *args):
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        result = func(*args)
+    return (time.perf_counter() - start) / ITERATIONS * 1000, result
+
+
+def run():
+    print("{:>10} {:>8} | {:>12} {:>10} {:>8} | {:>12} {:>10} {:>8}".format(
+        "grid", "boxes", "ref decode", "decode", "speedup", "ref encode", "encode", "speedup"))
+    for num_boxes_x, num_boxes_y in GRID_SIZES:
+        codec = rgb_grid.Codec(BenchmarkMessages(), params=get_params(num_boxes_x, num_boxes_y))
+        num_boxes = num_boxes_x * num_boxes_y
+        payload = os.urandom((num_boxes - 9) // 8 * 5)
+        image = get_noisy_frame(codec, payload)
+
+        ref_decode_ms, reference_data = time_call(reference_decode, codec, image)
+        decode_ms, result = time_call(codec.decode, image)
+        if result[2][0] != reference_data:
+            print("WARNING: decode output does not match the reference for "+str((num_boxes_x, num_boxes_y)))
+
+        ref_encode_ms, reference_image = time_call(reference_encode, codec, payload)
+        encode_ms, encoded_image = time_call(codec.encode, payload)
+        if not np.array_equal(encoded_image, reference_image):
+            print("WARNING: encode output does not match the reference for "+str((num_boxes_x, num_boxes_y)))
+
+        print("{:>10} {:>8} | {:>10.2f}ms {:>8.2f}ms {:>7.1f}x | {:>10.2f}ms {:>8.2f}ms {:>7.1f}x".format(
+            "%dx%d" % (num_boxes_x, num_boxes_y), num_boxes,
+            ref_decode_ms, decode_ms, ref_decode_ms / decode_ms,
+            ref_encode_ms, encode_ms, ref_encode_ms / encode_ms))
+
+    # Frames usually arrive at a different size than the codec draws them, compare resizing them first with sampling them directly
+    print()
+    print("{:>10} {:>10} | {:>12} {:>12} {:>8}".format("grid", "source", "resize", "sample", "speedup"))
+    for num_boxes_x, num_boxes_y in GRID_SIZES:
+        resize_codec = rgb_grid.Codec(BenchmarkMessages(), params=dict(get_params(num_boxes_x, num_boxes_y), sample_grid=0))
+        sample_codec = rgb_grid.Codec(BenchmarkMessages(), params=get_params(num_boxes_x, num_boxes_y))
+        payload = os.urandom((num_boxes_x * num_boxes_y - 9) // 8 * 5)
+        for source_size in SOURCE_SIZES:
+            image = cv2.resize(get_noisy_frame(sample_codec, payload), source_size)
+            resize_ms, resize_result = time_call(resize_codec.decode, image)
+            sample_ms, sample_result = time_call(sample_codec.decode, image)
+            if sample_result[1] != resize_result[1]:
+                print("WARNING: sampled decode does not match the resized decode for "+str((num_boxes_x, num_boxes_y)))
+            print("{:>10} {:>10} | {:>10.2f}ms {:>10.2f}ms {:>7.1f}x".format(
+                "%dx%d" % (num_boxes_x, num_boxes_y), "%dx%d" % source_size, resize_ms, sample_ms, resize_ms / sample_ms))
+
+
+if __name__ == '__main__':
+    run()
@@ -1,5 +1,6 @@
 import os,sys
 import base64, crcmod
+import reedsolo
 import numpy as np
 import cv2
 
@@ -7,11 +8,44 @@ DELIMITER = "-"
 VALID_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567="+DELIMITER
 DEBUG_IMAGE_PATH = "./temp/debug_images"
 
+# Symbol value of a white (empty) box, other symbols are an index into VALID_CHARS or the palette
+SYMBOL_WHITE = -1
+
+# Binary symbol mode frames are a length header, the payload, then a CRC-16
+# With FEC the frame is zero padded to fill the grid and Reed-Solomon encoded, fec_parity bytes per 255 byte codeword
+BINARY_HEADER_SIZE = 2
+BINARY_CRC_SIZE = 2
+
+# A frame is taken as a pilot frame when grouping its boxes by pilot symbol leaves less than this share of the color variance
+PILOT_VARIANCE_RATIO = 0.1
+PILOT_MIN_VARIANCE = 100
+# Two captures are of the same frame if at least this share of the boxes holding data in either one decode to the same symbol
+SAME_FRAME_AGREEMENT = 0.6
+
+# Fiducials are finder patterns (7x7 modules: black ring, white ring, black 3x3 center) in the four corners, inside white
+# strips left and right of the grid that are FIDUCIAL_STRIP modules wide. They keep FIDUCIAL_MARGIN modules from the frame
+# edges so a few pixels of cropping or shifting does not cut them off, and one module from the grid
+FIDUCIAL_STRIP = 11
+FIDUCIAL_MARGIN = 3
+# The frame is realigned when its mean box diff jumps to this many times the running average, and is at least FIDUCIAL_MIN_DIFF
+FIDUCIAL_REALIGN_RATIO = 2
+FIDUCIAL_MIN_DIFF = 10
+
 # Set parameters for the image and box sizes
 
 class Codec:
 
+    # Box steps are rounded down to a multiple of this, variants that line boxes up with the video encoder's blocks raise it
+    BOX_ALIGN = 1
+
     def __init__(self, msg, debug_mode=False, params=None):
+        self.debug_mode = debug_mode
+        self.msg = msg
+        self.write_one_debug_image = True
+        self.configure(params)
+
+    def configure(self, params=None):
+        # (Re)build the grid, palette and symbol mode from params, this also resets any calibration
         self.width, self.height = 1280, 720
         self.num_boxes_x = 40
         self.num_boxes_y = 35
@@ -24,8 +58,69 @@ class Codec:
             self.num_boxes_y = params["num_boxes_y"]
             self.gap_size = params["gap_size"]
 
-        self.box_size_x = (self.width - (self.num_boxes_x - 1) * self.gap_size) // self.num_boxes_x
+        # "base32" sends base32 text with a delimiter and CRC-8, "binary" packs bits_per_box bits of the payload into each box
+        self.symbol_mode = "base32"
+        self.bits_per_box = 6
+        self.fec_parity = 0
+        self.erasure_threshold = 0.2
+        self.palette_step = 50
+        self.calibration = False
+        self.calibration_rate = 0.05
+        self.tiles = 1
+        self.combine_frames = 4
+        self.sample_grid = 16
+        self.box_align = self.BOX_ALIGN
+        self.fiducials = False
+        self.fiducial_module = 6
+        if params:
+            self.symbol_mode = params.get("symbol_mode", self.symbol_mode)
+            self.bits_per_box = params.get("bits_per_box", self.bits_per_box)
+            self.fec_parity = params.get("fec_parity", self.fec_parity)
+            self.erasure_threshold = params.get("erasure_threshold", self.erasure_threshold)
+            self.palette_step = params.get("palette_step", self.palette_step)
+            self.calibration = params.get("calibration", self.calibration)
+            self.calibration_rate = params.get("calibration_rate", self.calibration_rate)
+            self.tiles = params.get("tiles", self.tiles)
+            self.combine_frames = params.get("combine_frames", self.combine_frames)
+            self.sample_grid = params.get("sample_grid", self.sample_grid)
+            self.box_align = params.get("box_align", self.box_align)
+            self.fiducials = params.get("fiducials", self.fiducials)
+            self.fiducial_module = params.get("fiducial_module", self.fiducial_module)
+
+        # Left edge of the grid, with fiducials the grid sits between the two strips holding them
+        self.grid_x = 0
+        if self.fiducials:
+            self.grid_x = -(-FIDUCIAL_STRIP * self.fiducial_module // self.box_align) * self.box_align
+
+        self.box_size_x = (self.width - 2 * self.grid_x - (self.num_boxes_x - 1) * self.gap_size) // self.num_boxes_x
         self.box_size_y = (self.height - (self.num_boxes_y - 1) * self.gap_size) //self.num_boxes_y
+        self.box_step_x = self.box_size_x + self.gap_size
+        self.box_step_y = self.box_size_y + self.gap_size
+        if self.box_align > 1:
+            if min(self.box_step_x, self.box_step_y) < self.box_align:
+                # Shrinking them to the next smaller block costs more than it gains, so only keep them on even pixels (the 2x2 chroma blocks)
+                self.box_align = 2
+                print("WARNING: Boxes are smaller than box_align, aligning them to "+str(self.box_align)+" instead")
+            # Every box starts on the align grid, boxes shrink and the grid gets as many of them as the frame has room for,
+            # so num_boxes_x and num_boxes_y only set the box size here
+            self.box_step_x = self.box_step_x // self.box_align * self.box_align
+            self.box_step_y = self.box_step_y // self.box_align * self.box_align
+            self.box_size_x = self.box_step_x - self.gap_size
+            self.box_size_y = self.box_step_y - self.gap_size
+            self.num_boxes_x = (self.width - 2 * self.grid_x + self.gap_size) // self.box_step_x
+            self.num_boxes_y = (self.height + self.gap_size) // self.box_step_y
+
+        # Top left corner of every box, in the order they are filled (column by column)
+        self.box_x = np.repeat(self.grid_x + np.arange(self.num_boxes_x) * self.box_step_x, self.num_boxes_y)
+        self.box_y = np.tile(np.arange(self.num_boxes_y) * self.box_step_y, self.num_boxes_x)
+
+        # Each tile is a band of whole columns carrying its own packet, the last one takes any leftover columns
+        if self.tiles > self.num_boxes_x:
+            print("WARNING: More tiles than columns of boxes, using "+str(self.num_boxes_x))
+            self.tiles = self.num_boxes_x
+        tile_columns = self.num_boxes_x // self.tiles
+        self.tile_bounds = [(t * tile_columns * self.num_boxes_y, (t + 1) * tile_columns * self.num_boxes_y) for t in range(self.tiles)]
+        self.tile_bounds[-1] = (self.tile_bounds[-1][0], self.num_boxes_x * self.num_boxes_y)
 
         if (params and params["box_reduction"] == False):
             self.box_reduction = 0
@@ -36,101 +131,474 @@ class Codec:
 
         self.background_color = (255, 255, 255)  # RGB values for the white background
 
-        self.encode_map, self.decode_map, self.map_range = self.create_mapping(50, VALID_CHARS)
-        self.debug_mode = debug_mode
-        self.msg = msg
-        self.write_one_debug_image = True
+        self.encode_map, self.decode_map, self.map_range = self.create_mapping(self.palette_step, VALID_CHARS)
+        self.palette = self.create_palette(self.palette_step)
+        max_bits_per_box = int(np.log2(len(self.palette)))
+        if self.bits_per_box > max_bits_per_box:
+            print("WARNING: Not enough RGB values for "+str(self.bits_per_box)+" bits per box, using "+str(max_bits_per_box))
+            self.bits_per_box = max_bits_per_box
+        self.__bit_shifts = np.arange(self.bits_per_box - 1, -1, -1)
+
+        if self.fec_parity and self.symbol_mode != "binary":
+            print("WARNING: fec_parity requires the binary symbol_mode, FEC is disabled")
+            self.fec_parity = 0
+        if self.fec_parity:
+            self.__rs = reedsolo.RSCodec(self.fec_parity)
+            self.__gf_log = np.array(self.__rs.gf_log, dtype=np.int64)
+            self.__gf_exp = np.array(self.__rs.gf_exp, dtype=np.int64)
+        # Codeword of a message with a single 1 byte, by (message size, position), for patching cached codewords
+        self.__unit_codewords = {}
+        self.__create_symbol_colors()
+        self.__create_templates()
+        self.last_result = None
+        self.last_results = []
+        # Frame size and transform the sample points were worked out for, they only change when one of those does
+        self.__sample_key = None
+        # Where the grid is in the received frames, found from the fiducials, and the running average of the mean box diff
+        self.__transform = None
+        self.__transform_shape = None
+        self.__frame_diff = None
+        self.realign_count = 0
+        # Box averages of the consecutive captures of the frame being received, newest last
+        self.__captures = []
+
+        # The pilot frame cycles through every symbol color, each one needs at least two boxes to tell it from data
+        self.__pilot_symbols = np.arange(self.num_boxes_x * self.num_boxes_y) % len(self.symbol_colors)
+        if self.calibration and len(self.__pilot_symbols) < 2 * len(self.symbol_colors):
+            print("WARNING: Not enough boxes for a pilot frame, calibration is disabled")
+            self.calibration = False
+
+        if self.get_payload_capacity() <= 0:
+            print("WARNING: The grid is too small to carry any payload with these codec params")
+
+    def get_empty_tiles(self, result):
+        # Whether each tile of a DecodeResult is all white, nothing was sent in it. A tile that failed to decode has empty data too
+        return [bool((result.symbols[start:end] == SYMBOL_WHITE).all()) for start, end in self.tile_bounds]
+
+    def get_payload_capacity(self):
+        # Largest raw_data in bytes that fits in every tile, the smallest tile sets the limit
+        num_boxes = min(end - start for start, end in self.tile_bounds)
+        if self.symbol_mode == "binary":
+            if self.fec_parity:
+                available = self.__fec_sizes(num_boxes)[0]
+            else:
+                available = num_boxes * self.bits_per_box // 8
+            return max(0, min(available - BINARY_HEADER_SIZE - BINARY_CRC_SIZE, 2 ** (8 * BINARY_HEADER_SIZE) - 1))
+        # base32 turns every 5 bytes into 8 characters, followed by the delimiter and 8 characters of CRC
+        return max(0, (num_boxes - 1 - 8) // 8 * 5)
 
 
     def encode(self, raw_data, local_seq=None, remote_seq=None):
+        return self.encode_packets([raw_data])
+
+    def encode_packets(self, packets, cache=None, cache_keys=None):
+        # One packet per tile, tiles without a packet are left white.
+        # With a FrameCache, cache_keys name each packet without the bytes that change from one send to the next (like a nonce),
+        # a packet whose key is cached is patched from its earlier encoding instead of being encoded again
+        box_symbols = np.full(self.num_boxes_x * self.num_boxes_y, len(self.symbol_colors) - 1)
+        for index, ((start, end), raw_data) in enumerate(zip(self.tile_bounds, packets)):
+            # Without FEC there is no Reed-Solomon encode to save, framing again costs no more than a cache lookup
+            if cache is None or cache_keys[index] is None or not self.fec_parity:
+                symbols = self.__frame_symbols(raw_data, end - start)
+            else:
+                symbols = self.__cached_frame_symbols(cache, (start, end, cache_keys[index]), raw_data, end - start)
+            box_symbols[start:end] = self.__fill_boxes(symbols, end - start)
+        return self.render(self.symbol_colors[box_symbols])
+
+    def encode_pilot(self):
+        # Known frame the receiver calibrates its symbol colors against
+        return self.render(self.symbol_colors[self.__pilot_symbols])
+
+    def __frame_symbols(self, raw_data, num_boxes):
+        # Index into symbol_colors of every symbol in the frame for raw_data, in order
+
+        if self.symbol_mode == "binary":
+            frame = self.__binary_message(raw_data, num_boxes)
+            if self.fec_parity:
+                frame = bytes(self.__rs.encode(frame))
+            return self.__pack_symbols(frame)
 
         base32_data = base64.b32encode(raw_data).decode('utf-8')
         crc = self.__getCRC(base32_data)
 
         line = (base32_data + DELIMITER + crc)
-        grid = np.ones((self.height, self.width, 3), dtype=np.uint8)
-        grid[:self.num_boxes_y * (self.box_size_y + self.gap_size), :self.num_boxes_x * (self.box_size_x + self.gap_size), :] = self.background_color
-        i = 0
-        j = 0
-
-        for c in line:
-
-            # This fills up the current box
-            grid[j:j + self.box_size_y, i:i + self.box_size_x, :] = self.encode_map[c]
+        return self.__char_symbols[np.frombuffer(line.encode("utf-8"), dtype=np.uint8)]
+
+
+    def __binary_message(self, raw_data, num_boxes):
+        # Length header, payload and CRC, with FEC zero padded to the message size of the tile's codewords
+        frame = len(raw_data).to_bytes(BINARY_HEADER_SIZE, byteorder='big') + raw_data
+        frame += self.__getBinaryCRC(frame)
+        if self.fec_parity:
+            frame = frame.ljust(self.__fec_sizes(num_boxes)[0], b"\0")
+        return frame
+
+    def __cached_frame_symbols(self, cache, key, raw_data, num_boxes):
+        # Only the Reed-Solomon encode is worth keeping, the rest of the framing is cheap enough to redo when the bytes differ
+        entry = cache.get(key)
+        if entry is not None and entry[0] == raw_data:
+            return entry[1]
+        if entry is not None:
+            codeword = self.__patch_codeword(entry[2], entry[0], raw_data, num_boxes)
+        else:
+            codeword = np.frombuffer(bytes(self.__rs.encode(self.__binary_message(raw_data, num_boxes))), dtype=np.uint8)
+        symbols = self.__pack_symbols(codeword.tobytes())
+        cache.put(key, (raw_data, symbols, codeword), len(raw_data) + symbols.nbytes + codeword.nbytes)
+        return symbols
+
+    def __patch_codeword(self, codeword, old_raw_data, raw_data, num_boxes):
+        # Reed-Solomon is linear over GF(256), so the new codeword is the old one plus, for every message byte that changed,
+        # the codeword of a single 1 at that position scaled by the change. Adding in GF(256) is xor
+        old_message = np.frombuffer(self.__binary_message(old_raw_data, num_boxes), dtype=np.uint8)
+        message = np.frombuffer(self.__binary_message(raw_data, num_boxes), dtype=np.uint8)
+        delta = old_message ^ message
+        codeword = codeword.copy()
+        for position in np.flatnonzero(delta):
+            unit = self.__unit_codeword(len(message), position)
+            scaled = self.__gf_exp[(self.__gf_log[unit] + self.__gf_log[delta[position]]) % 255]
+            codeword ^= np.where(unit == 0, 0, scaled).astype(np.uint8)
+        return codeword
+
+    def __unit_codeword(self, message_size, position):
+        key = (message_size, position)
+        if key not in self.__unit_codewords:
+            message = bytearray(message_size)
+            message[position] = 1
+            self.__unit_codewords[key] = np.frombuffer(bytes(self.__rs.encode(message)), dtype=np.uint8)
+        return self.__unit_codewords[key]
+
+    def render(self, box_colors):
+        # Paint one color per box (in fill order) onto a copy of the background template
+        # Every row inside a row of boxes is identical, so build one pixel row per row of boxes and broadcast it down
+        table = np.empty((self.num_boxes_y, self.num_boxes_x + 1, 3), dtype=np.uint8)
+        table[:, :self.num_boxes_x] = box_colors.reshape(self.num_boxes_x, self.num_boxes_y, 3).transpose(1, 0, 2)
+        table[:, self.num_boxes_x] = self.background_color
+        grid_width = len(self.__column_labels)
+        rows = table[:, self.__column_labels].reshape(self.num_boxes_y, 1, grid_width * 3)
+
+        grid = self.__background.copy()
+        stride_y = grid.strides[0]
+        box_rows = np.lib.stride_tricks.as_strided(grid[:, self.grid_x:], shape=(self.num_boxes_y, self.box_size_y, grid_width * 3),
+                                                   strides=(stride_y * self.box_step_y, stride_y, 1))
+        box_rows[...] = rows
+        return grid
 
-            j += self.box_size_y + self.gap_size
-            if j >= (self.num_boxes_y) * (self.box_size_y + self.gap_size):
-                j = 0
-                i += self.box_size_x + self.gap_size
-                if i >= (self.num_boxes_x) * (self.box_size_x + self.gap_size):
-                    i = 0
+    def __fill_boxes(self, symbols, num_boxes):
+        # Symbol for every box, boxes are filled column by column, wrapping around to the first box if there are more symbols than boxes
+        box_symbols = np.full(num_boxes, len(self.symbol_colors) - 1)
+        if len(symbols) > num_boxes:
+            box_symbols[np.arange(len(symbols) - num_boxes, len(symbols)) % num_boxes] = symbols[-num_boxes:]
+        else:
+            box_symbols[:len(symbols)] = symbols
+        return box_symbols
+
+    def __create_templates(self):
+        # Background the boxes are painted on, anything outside the grid (and the fiducial strips) is left at 1
+        self.__background = np.ones((self.height, self.width, 3), dtype=np.uint8)
+        self.__background[:self.num_boxes_y * self.box_step_y, self.grid_x:self.grid_x + self.num_boxes_x * self.box_step_x, :] = self.background_color
+        if self.fiducials:
+            self.__background[:, :self.grid_x] = self.background_color
+            self.__background[:, self.width - self.grid_x:] = self.background_color
+            module = self.fiducial_module
+            for x, y in self.__fiducial_origins():
+                self.__background[y:y + 7 * module, x:x + 7 * module] = 0
+                self.__background[y + module:y + 6 * module, x + module:x + 6 * module] = self.background_color
+                self.__background[y + 2 * module:y + 5 * module, x + 2 * module:x + 5 * module] = 0
+
+        # Which column of boxes each pixel column of the grid belongs to, num_boxes_x for gaps
+        self.__column_labels = np.full(self.num_boxes_x * self.box_step_x, self.num_boxes_x)
+        for i in range(self.num_boxes_x):
+            self.__column_labels[i * self.box_step_x:i * self.box_step_x + self.box_size_x] = i
 
-        return grid
+        # Index into VALID_CHARS (and symbol_colors) for every character, indexed by its utf-8 byte
+        self.__char_symbols = np.zeros(256, dtype=np.int64)
+        for index, c in enumerate(VALID_CHARS):
+            self.__char_symbols[ord(c)] = index
 
 
     def decode(self, raw_image, name=None):
+        return self.decode_packets(raw_image, name)[0]
+
+    def decode_packets(self, raw_image, name=None):
+        # Decode every tile on its own, returns one (is_valid, data, (raw, image, diff, corrected)) per tile
+        self.last_results = []
+        return self.__decode_frame(self.decode_symbols(raw_image), name)
+
+    def decode_batch(self, frames, names=None):
+        # decode_packets for a stack of frames the same size, an (N, H, W, 3) array or a list, one list of tile results per frame.
+        # Box colors for the whole stack come from one gather and one reduction, classifying and framing are still done
+        # frame by frame because calibration and capture combining carry over from one frame to the next
+        if names is None:
+            names = [None] * len(frames)
+        self.last_results = []
+        box_averages = self.get_stack_box_averages(np.asarray(frames))
+        return [self.__decode_frame(self.classify(averages, frame), name) for averages, frame, name in zip(box_averages, frames, names)]
+
+    def decode_box_averages(self, box_averages, image=None, name=None):
+        # decode_packets for box colors that were already read from the frame, e.g. by get_stack_box_averages in another process
+        self.last_results = []
+        return self.__decode_frame(self.classify(box_averages, image), name)
+
+    def __decode_frame(self, result, name):
+        # last_results holds the DecodeResult of every frame from the latest decode_packets, decode_batch or decode_box_averages call
+        self.last_result = result
+        self.last_results.append(result)
 
-        image = cv2.resize(raw_image, (self.width, self.height))
-
-        x_offset = self.box_size_x+self.gap_size
-        y_offset = self.box_size_y+self.gap_size
-        
-        def get_raw_data():
+        if self.debug_mode:
+            cv2.imwrite(os.path.join(DEBUG_IMAGE_PATH, "debug_image.bmp"),result.image)
+
+        if self.calibration and self.calibrate(result):
+            self.msg.print("CODEC: calibrated from pilot frame "+str(name))
+            self.__captures = []
+            return [(False, "".encode("utf-8"), (b"", result.image, 0, 0))] * self.tiles
+
+        decoded = self.__decode_tiles(result, name, range(self.tiles))
+        self.__add_capture(result)
+        if self.fiducials:
+            self.__check_alignment(result)
+
+        # Tiles that failed get another try with the box colors averaged over every capture of this frame, the noise averages out
+        failed = [index for index, tile in enumerate(decoded) if not tile[0]]
+        if len(self.__captures) > 1 and failed:
+            combined = self.classify(np.mean([box_averages for box_averages, symbols in self.__captures], axis=0), result.image)
+            for index, tile in zip(failed, self.__decode_tiles(combined, str(name)+" combined", failed)):
+                if tile[0]:
+                    decoded[index] = tile
+                    result.recovered += 1
+            if result.recovered:
+                self.msg.print("CODEC: recovered "+str(result.recovered)+" tiles from "+str(len(self.__captures))+" captures "+str(name))
+        return decoded
+
+    def __decode_tiles(self, result, name, tile_indices):
+        decoded = []
+        verified = np.zeros(len(result.symbols), dtype=bool)
+        verified_symbols = np.zeros(len(result.symbols), dtype=np.int64)
+        for index in tile_indices:
+            start, end = self.tile_bounds[index]
+            tile = result.tile(start, end)
+
+            # Nothing was sent in this tile
+            if (tile.symbols == SYMBOL_WHITE).all():
+                decoded.append((False, "".encode("utf-8"), (b"", result.image, 0, 0)))
+                continue
+
+            if self.symbol_mode == "binary":
+                decoded.append(self.__decode_binary(tile, name))
+            else:
+                decoded.append(self.__decode_base32(tile, name))
+
+            if decoded[-1][0]:
+                verified[start:end] = True
+                verified_symbols[start:end] = self.__fill_boxes(self.__frame_symbols(decoded[-1][1], end - start), end - start)
+
+        # The CRC passed so the symbol of every box in the tile is known, nudge the centroids towards what was actually received
+        if self.calibration and verified.any():
+            self.__update_centroids(result.box_averages[verified], verified_symbols[verified], self.calibration_rate)
+        return decoded
+
+    def __add_capture(self, result):
+        # Start over unless this capture matches the previous one, the sender repeats each frame for a while so several captures line up
+        if self.combine_frames < 2:
+            return
+        if self.__captures:
+            previous = self.__captures[-1][1]
+            has_data = (result.symbols != SYMBOL_WHITE) | (previous != SYMBOL_WHITE)
+            if not has_data.any() or (result.symbols == previous)[has_data].mean() < SAME_FRAME_AGREEMENT:
+                self.__captures = []
+        self.__captures = self.__captures[1 - self.combine_frames:] + [(result.box_averages, result.symbols)]
+
+
+    def decode_symbols(self, raw_image):
+        # Soft decision decode of every box, without any framing or CRC checks
+        return self.classify(self.get_stack_box_averages(raw_image[np.newaxis])[0], raw_image)
+
+    def get_stack_box_averages(self, frames):
+        # Box colors of every frame in an (N, H, W, 3) stack, the fiducial transform is worked out from the first frame.
+        # Frames at the codec's own size are averaged in place, others are sampled where they are unless sample_grid is 0
+        transform = None
+        if self.fiducials:
+            transform = self.__get_transform(frames[0])
+        if transform is None and frames.shape[1:3] == (self.height, self.width):
+            return [self.get_box_averages(frame) for frame in frames]
+        if transform is None and self.sample_grid <= 0:
+            return [self.get_box_averages(cv2.resize(frame, (self.width, self.height))) for frame in frames]
+        return self.get_box_samples(frames, transform)
+
+    def classify(self, box_averages, image=None):
+        # Nearest symbol color for every box, confidence compares the distance to it with the distance to the second nearest
+        # Squared distances are expanded as |a|^2 - 2a.c + |c|^2 so the whole grid is one matrix multiply
+        distance = self.__centroid_norms - 2 * box_averages @ self.centroids.T
+        rows = np.arange(len(distance))
+        nearest = distance.argmin(axis=1)
+        d1 = distance[rows, nearest]
+        distance[rows, nearest] = np.inf
+        d2 = distance.min(axis=1)
+
+        box_norms = (box_averages * box_averages).sum(axis=1)
+        d1 = np.sqrt(np.maximum(d1 + box_norms, 0))
+        d2 = np.sqrt(np.maximum(d2 + box_norms, 0))
+
+        symbols = self.symbol_values[nearest]
+        confidences = 1 - d1 / d2
+        diffs = np.abs(box_averages - self.centroids[nearest]).sum(axis=1)
+
+        # Boxes further than the spacing between symbol colors from every one of them are erased too, whatever they are
+        erasures = (confidences < self.erasure_threshold) | (d1 > self.__centroid_spacing)
+        return DecodeResult(symbols, confidences, erasures, diffs, box_averages, image)
+
+    def calibrate(self, result):
+        # If the boxes group by pilot symbol (nearly all of the color variance is between the groups), this is a pilot frame
+        # and the group means become the centroids
+        box_averages = result.box_averages
+        total = ((box_averages - box_averages.mean(axis=0)) ** 2).sum(axis=1).mean()
+        means = self.__symbol_means(box_averages, self.__pilot_symbols)
+        within = ((box_averages - means[self.__pilot_symbols]) ** 2).sum(axis=1).mean()
+        if total < PILOT_MIN_VARIANCE or within > PILOT_VARIANCE_RATIO * total:
+            return False
+
+        self.__update_centroids(box_averages, self.__pilot_symbols, 1)
+        result.is_pilot = True
+        return True
+
+    def __symbol_means(self, box_averages, box_symbols):
+        counts = np.bincount(box_symbols, minlength=len(self.centroids))
+        sums = np.stack([np.bincount(box_symbols, weights=box_averages[:, c], minlength=len(self.centroids)) for c in range(3)], axis=1)
+        means = self.centroids.copy()
+        means[counts > 0] = sums[counts > 0] / counts[counts > 0, np.newaxis]
+        return means
+
+    def __update_centroids(self, box_averages, box_symbols, rate):
+        self.__set_centroids((1 - rate) * self.centroids + rate * self.__symbol_means(box_averages, box_symbols))
+
+    def __set_centroids(self, centroids):
+        self.centroids = centroids
+        self.__centroid_norms = (centroids * centroids).sum(axis=1)
+        spacing = np.linalg.norm(centroids[:, np.newaxis] - centroids, axis=2)
+        self.__centroid_spacing = spacing[spacing > 0].min()
+
+
+    def __decode_base32(self, result, name):
+
+        # Stop at the first white box, if this happens it's ether the end or something went wrong
+        white = np.flatnonzero(result.symbols == SYMBOL_WHITE)
+        end = white[0] if len(white) > 0 else len(result.symbols)
+        diff = result.diffs[:end].mean() if end > 0 else 0
+        raw_data = self.__symbol_chars[result.symbols[:end]].tobytes().decode("utf-8")
+        image = result.image
 
-            boxes = self.__get_decode_boxes(image)
 
-            boxes_avg = self.__get_box_averages(boxes)
-      
-            boxes_mapped = self.__snap_to_map_range(boxes_avg)
+        try:
+            data, crc = raw_data.split(DELIMITER,1)
+        except Exception as e:
+            self.msg.print("CODEC: error parsing raw data "+str(name))
+            # self.__write_debug_images(image,name)
+            return (False, "".encode("utf-8"), (raw_data, image, diff, 0))
 
 
-            raw_data=""
-            total_diff = 0
-            total = 0
+        if crc == self.__getCRC(data):
+            return (True, base64.b32decode(data), (raw_data, image, diff, 0))
+        else:
+            self.msg.print("CODEC: CRC error "+str(name))
+           # self.__write_debug_images(image,name)
+            return (False, "".encode("utf-8"), (raw_data, image, diff, 0))
 
-            for box in boxes_mapped:
-                r_value,g_value,b_value, diff = box
-                
-                # Exit if we encounter a white box, if this happens it's ether the end or something went wrong
-                if (r_value == 255 and g_value == 255 and b_value == 255):
-                    return raw_data, total_diff/total
-                total_diff += diff
-                total +=1
 
-                # This is a valid box, it is not white
-                if (r_value == 255 and g_value == 255 and b_value == 255) == False:
-                    index = ("(%d, %d, %d)") % (r_value, g_value, b_value)
-                    try:
-                        raw_data+=(self.decode_map[index])
-                    except KeyError:
-                        self.msg.print("CODEC: key error in decode_map")
+    def __decode_binary(self, result, name):
 
+        if self.fec_parity:
+            return self.__decode_binary_fec(result, name)
 
-            return raw_data, total_diff/total
+        symbols, diffs, image = result.symbols, result.diffs, result.image
 
-            
+        # Read the length header first to know how many boxes the frame covers
+        header_boxes = self.__boxes_for_bytes(BINARY_HEADER_SIZE)
+        if (symbols[:header_boxes] < 0).any():
+            self.msg.print("CODEC: error parsing raw data "+str(name))
+            return (False, "".encode("utf-8"), (b"", image, diffs[:header_boxes].mean(), 0))
 
-        raw_data, diff = get_raw_data()
+        length = int.from_bytes(self.__unpack_symbols(symbols[:header_boxes])[:BINARY_HEADER_SIZE], byteorder='big')
+        frame_size = BINARY_HEADER_SIZE + length + BINARY_CRC_SIZE
+        frame_boxes = self.__boxes_for_bytes(frame_size)
+        if frame_boxes > len(symbols) or (symbols[:frame_boxes] < 0).any():
+            self.msg.print("CODEC: error parsing raw data "+str(name))
+            return (False, "".encode("utf-8"), (b"", image, diffs[:header_boxes].mean(), 0))
+
+        diff = diffs[:frame_boxes].mean()
+        if self.__is_blank(symbols[:frame_boxes]):
+            self.msg.print("CODEC: blank frame "+str(name))
+            return (False, "".encode("utf-8"), (b"", image, diff, 0))
+        raw_data = self.__unpack_symbols(symbols[:frame_boxes])[:frame_size]
+        if raw_data[-BINARY_CRC_SIZE:] == self.__getBinaryCRC(raw_data[:-BINARY_CRC_SIZE]):
+            return (True, raw_data[BINARY_HEADER_SIZE:-BINARY_CRC_SIZE], (raw_data, image, diff, 0))
+        else:
+            self.msg.print("CODEC: CRC error "+str(name))
+            return (False, "".encode("utf-8"), (raw_data, image, diff, 0))
+
+    def __decode_binary_fec(self, result, name):
+
+        # The codeword always fills the tile
+        codeword_size = self.__fec_sizes(len(result.symbols))[1]
+        num_boxes = self.__boxes_for_bytes(codeword_size)
+        symbols = result.symbols[:num_boxes]
+        diff = result.diffs[:num_boxes].mean()
+        image = result.image
+        if self.__is_blank(symbols):
+            self.msg.print("CODEC: blank frame "+str(name))
+            return (False, "".encode("utf-8"), (b"", image, diff, 0))
+        codeword = self.__unpack_symbols(np.where(symbols < 0, 0, symbols))[:codeword_size]
+
+        # White boxes and boxes below the erasure threshold are passed to Reed-Solomon as erasures, since it can fix
+        # twice as many erasures as errors. If there are too many of them, fall back to only erasing the white boxes
+        message = None
+        for erased in (symbols < 0) | result.erasures[:num_boxes], symbols < 0:
+            try:
+                message, _, errata_pos = self.__rs.decode(codeword, erase_pos=self.__erased_bytes(erased, codeword_size))
+                break
+            except reedsolo.ReedSolomonError:
+                continue
+        if message is None:
+            self.msg.print("CODEC: FEC error "+str(name))
+            return (False, "".encode("utf-8"), (codeword, image, diff, 0))
+        corrected = len(errata_pos)
+
+        length = int.from_bytes(message[:BINARY_HEADER_SIZE], byteorder='big')
+        frame_size = BINARY_HEADER_SIZE + length + BINARY_CRC_SIZE
+        if frame_size > len(message):
+            self.msg.print("CODEC: error parsing raw data "+str(name))
+            return (False, "".encode("utf-8"), (codeword, image, diff, corrected))
 
+        raw_data = bytes(message[:frame_size])
+        if raw_data[-BINARY_CRC_SIZE:] == self.__getBinaryCRC(raw_data[:-BINARY_CRC_SIZE]):
+            return (True, raw_data[BINARY_HEADER_SIZE:-BINARY_CRC_SIZE], (raw_data, image, diff, corrected))
+        else:
+            self.msg.print("CODEC: CRC error "+str(name))
+            return (False, "".encode("utf-8"), (raw_data, image, diff, corrected))
 
-        if self.debug_mode:
-            cv2.imwrite(os.path.join(DEBUG_IMAGE_PATH, "debug_image.bmp"),image)
+    def __erased_bytes(self, erased_boxes, codeword_size):
+        # Byte positions in the codeword covered by the erased boxes
+        erase_pos = set()
+        for box in np.flatnonzero(erased_boxes):
+            erase_pos.update(range(box * self.bits_per_box // 8, ((box + 1) * self.bits_per_box - 1) // 8 + 1))
+        return sorted(pos for pos in erase_pos if pos < codeword_size)
 
+    def __fec_sizes(self, num_boxes):
+        # Message and codeword size in bytes for a Reed-Solomon codeword filling num_boxes boxes
+        available = num_boxes * self.bits_per_box // 8
+        message_size = available - self.fec_parity * -(-available // 255)
+        return message_size, message_size + self.fec_parity * -(-message_size // (255 - self.fec_parity))
 
-        try:
-            data, crc = raw_data.split(DELIMITER,1)
-        except Exception as e:
-            self.msg.print("CODEC: error parsing raw data "+str(name))
-            # self.__write_debug_images(image,name)
-            return (False, "".encode("utf-8"), (raw_data, image, diff))
+    def __boxes_for_bytes(self, size):
+        return -(-size * 8 // self.bits_per_box)
 
+    def __pack_symbols(self, data):
+        # Split bytes into bits_per_box bit symbols, most significant bit first, zero padding the last one
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+        bits = np.concatenate((bits, np.zeros(-len(bits) % self.bits_per_box, dtype=np.uint8)))
+        return bits.reshape(-1, self.bits_per_box) @ (1 << self.__bit_shifts)
 
-        if crc == self.__getCRC(data):
-            return (True, base64.b32decode(data), (raw_data, image, diff))
-        else:
-            self.msg.print("CODEC: CRC error "+str(name))
-           # self.__write_debug_images(image,name)
-            return (False, "".encode("utf-8"), (raw_data, image, diff))
+    def __unpack_symbols(self, symbols):
+        bits = (symbols[:, np.newaxis] >> self.__bit_shifts) & 1
+        return np.packbits(bits.astype(np.uint8)).tobytes()
 
 
     def get_debug_image(self, original_image, rgb_avg=None, rgb_map=None):
@@ -151,15 +619,16 @@ class Codec:
         image = original_image.copy()
 
         if rgb_avg is None:
-            rgb_avg = self.__get_box_averages(self.__get_decode_boxes(original_image))
+            rgb_avg = self.get_box_averages(original_image)
         if rgb_map is None:
-            rgb_map = self.__snap_to_map_range(rgb_avg)
+            result = self.classify(rgb_avg)
+            rgb_map = self.symbol_colors[np.where(result.symbols == SYMBOL_WHITE, len(self.symbol_colors) - 1, result.symbols)]
 
         count = 0
         for i in range(self.num_boxes_x):
             for j in range(self.num_boxes_y):
                 # Calculate box coordinates
-                x1 = i * (self.box_size_x + self.gap_size) + self.box_reduction
+                x1 = self.grid_x + i * (self.box_size_x + self.gap_size) + self.box_reduction
                 y1 = j * (self.box_size_y + self.gap_size) + self.box_reduction
                 x2 = x1 + self.box_size_x - 2 * self.box_reduction
                 y2 = y1 + self.box_size_y - 2 * self.box_reduction
@@ -191,7 +660,7 @@ class Codec:
         for i in range(self.num_boxes_x):
             for j in range(self.num_boxes_y):
                 # Calculate box coordinates
-                x1 = i * (self.box_size_x + self.gap_size) + self.box_reduction
+                x1 = self.grid_x + i * (self.box_size_x + self.gap_size) + self.box_reduction
                 y1 = j * (self.box_size_y + self.gap_size) + self.box_reduction
                 x2 = x1 + self.box_size_x - 2 * self.box_reduction
                 y2 = y1 + self.box_size_y - 2 * self.box_reduction
@@ -201,69 +670,144 @@ class Codec:
         return image
 
 
-    def __get_decode_boxes(self, image):
-        #boxes = np.empty((num_boxes_x * num_boxes_y, box_size_y - 2 * box_reduction, box_size_x - 2 * box_reduction, 3), dtype=np.uint8)
-
-        boxes = []
-
-        x_coords = np.arange(0, self.num_boxes_x * (self.box_size_x + self.gap_size) - self.gap_size, self.box_size_x + self.gap_size)
-        y_coords = np.arange(0, self.num_boxes_y * (self.box_size_y + self.gap_size) - self.gap_size, self.box_size_y + self.gap_size)
-
-        for i, x in enumerate(x_coords):
-            for j, y in enumerate(y_coords):
-                x1, x2 = x + self.box_reduction, x + self.box_size_x - self.box_reduction
-                y1, y2 = y + self.box_reduction, y + self.box_size_y - self.box_reduction
-
-                boxes.append(image[y1:y2, x1:x2])
-
-        return boxes
-
-    def __get_box_averages(self, boxes):
-        result_array = []
-
-        for box in boxes:
-            # Assuming 'boxes' is a NumPy array of shape (num_boxes, height, width, 3)
-            # where the last dimension represents RGB values
-
-            # Calculate the mean for each channel directly using NumPy
-            r_avg = np.mean(box[:, :, 0])
-            g_avg = np.mean(box[:, :, 1])
-            b_avg = np.mean(box[:, :, 2])
-
-            result_array.append((r_avg, g_avg, b_avg))
-
-        return result_array
-    
-    def __snap_to_map_range(self, box_averages):
-
-        result_array = []
-
-        # Convert the value_range to a NumPy array for easier calculations
-        value_range_np = np.array(self.map_range)
-
-        for rgb in box_averages:
-            diff = 0
-            # Convert the RGB tuple to a NumPy array
-            rgb_np = np.array(rgb)
-
-            # Find the index of the closest value in the range for each channel
-            r_index = np.argmin(np.abs(rgb_np[0] - value_range_np))
-            g_index = np.argmin(np.abs(rgb_np[1] - value_range_np))
-            b_index = np.argmin(np.abs(rgb_np[2] - value_range_np))
-
-            # Calculate the absolute differences and sum them up
-            diff = np.abs(rgb_np[0] - self.map_range[r_index]) + np.abs(rgb_np[1] - self.map_range[g_index]) + np.abs(rgb_np[2] - self.map_range[b_index])
-
-            # Snap each value to the closest one in the range
-            r_snap = value_range_np[r_index]
-            g_snap = value_range_np[g_index]
-            b_snap = value_range_np[b_index]
-
-            result_array.append((r_snap, g_snap, b_snap, diff))
+    def get_box_averages(self, image):
+        # Mean color of the inside of every box, using an integral image so each box is four lookups
+        integral = cv2.integral(image)
+        y1, y2 = self.box_y + self.box_reduction, self.box_y + self.box_size_y - self.box_reduction
+        x1, x2 = self.box_x + self.box_reduction, self.box_x + self.box_size_x - self.box_reduction
+        sums = integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + integral[y1, x1]
+        return self.color_features(sums / ((y2 - y1) * (x2 - x1))[:, np.newaxis])
+
+    def get_box_samples(self, image, transform=None):
+        # Mean color of a sample_grid x sample_grid lattice of pixels inside every box, read straight from the frame at
+        # whatever size it arrived in, so only the sampled pixels are touched and nothing is resized.
+        # transform maps codec coordinates to frame coordinates, without one the frame is just scaled.
+        # image can also be an (N, H, W, 3) stack of frames, the result then has one row of boxes per frame
+        height, width, channels = image.shape[-3:]
+        if transform is None:
+            transform = np.diag((width / self.width, height / self.height, 1))
+        if self.__sample_key != (image.shape[-3:], transform.tobytes()):
+            self.__create_sample_points(height, width, channels, transform)
+            self.__sample_key = (image.shape[-3:], transform.tobytes())
+        frames = image.reshape(-1, height * width * channels)
+        samples = np.take(frames, self.__sample_points, axis=1).reshape(-1, self.__sample_points.shape[1])
+        sums = cv2.reduce(samples, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+        averages = self.color_features(sums.reshape(len(frames), -1, channels) / self.__sample_points.shape[1])
+        return averages if image.ndim == 4 else averages[0]
+
+    def __create_sample_points(self, height, width, channels, transform):
+        # Flat index into the frame's bytes of every sample point, one row per channel of each box in fill order
+        def lattice(start, size, scale):
+            # Evenly spaced positions across the inside of each box in codec coordinates, at most one per frame pixel
+            span = size - 2 * self.box_reduction
+            count = int(max(1, span * scale))
+            if self.sample_grid > 0:
+                count = min(self.sample_grid, count)
+            return start[:, np.newaxis] + self.box_reduction + (np.arange(count) + 0.5) / count * span
+
+        sample_y = lattice(self.box_y, self.box_size_y, np.hypot(transform[0, 1], transform[1, 1]))
+        sample_x = lattice(self.box_x, self.box_size_x, np.hypot(transform[0, 0], transform[1, 0]))
+        points = np.stack(np.broadcast_arrays(sample_x[:, np.newaxis, :], sample_y[:, :, np.newaxis]), axis=-1)
+        points = cv2.perspectiveTransform(points.reshape(-1, 1, 2), transform).reshape(len(self.box_x), -1, 2)
+        x = np.clip(np.floor(points[:, :, 0]), 0, width - 1).astype(np.int64)
+        y = np.clip(np.floor(points[:, :, 1]), 0, height - 1).astype(np.int64)
+        pixels = (y * width + x)[:, np.newaxis, :]
+        self.__sample_points = (pixels * channels + np.arange(channels)[:, np.newaxis]).reshape(len(self.box_x) * channels, -1)
+
+    def __fiducial_origins(self):
+        # Top left corner of each fiducial in codec coordinates, clockwise from the top left
+        module = self.fiducial_module
+        left = self.grid_x - 8 * module
+        right = self.width - self.grid_x + module
+        top, bottom = FIDUCIAL_MARGIN * module, self.height - (7 + FIDUCIAL_MARGIN) * module
+        return [(left, top), (right, top), (right, bottom), (left, bottom)]
+
+    def find_fiducials(self, image):
+        # Centers of the four fiducials in the frame, clockwise from the top left, or None if they are not all there.
+        # A fiducial is a dark, roughly square blob with a hole that holds another dark blob about (3/7)^2 of its size
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        dark = cv2.threshold(gray, 100, 255, cv2.THRESH_BINARY_INV)[1]
+        contours, hierarchy = cv2.findContours(dark, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        if hierarchy is None:
+            return None
+        hierarchy = hierarchy[0]
+        max_area = gray.size * 0.05
+
+        centers = []
+        for index, contour in enumerate(contours):
+            hole = hierarchy[index][2]
+            if hole < 0 or hierarchy[hole][2] < 0:
+                continue
+            x, y, w, h = cv2.boundingRect(contour)
+            area = cv2.contourArea(contour)
+            if area > max_area or area < 0.7 * w * h or not 0.7 < w / h < 1.4:
+                continue
+            center_area = cv2.contourArea(contours[hierarchy[hole][2]])
+            if not 0.08 < center_area / area < 0.35:
+                continue
+            centers.append((x + w / 2, y + h / 2))
+        if len(centers) < 4:
+            return None
+
+        # The one closest to each corner of the frame
+        centers = np.array(centers)
+        height, width = gray.shape
+        corners = np.array([(0, 0), (width, 0), (width, height), (0, height)])
+        chosen = [np.linalg.norm(centers - corner, axis=1).argmin() for corner in corners]
+        if len(set(chosen)) < 4:
+            return None
+        return centers[chosen].astype(np.float32)
+
+    def __get_transform(self, image):
+        # Fiducials are only looked for again when the frame size changes or __check_alignment asks for it
+        if self.__transform_shape != image.shape:
+            self.__transform_shape = image.shape
+            centers = self.find_fiducials(image)
+            self.__transform = None
+            if centers is None:
+                self.msg.print("CODEC: fiducials not found, assuming the frame is only scaled")
+            else:
+                origins = np.array(self.__fiducial_origins(), dtype=np.float32) + 3.5 * self.fiducial_module
+                self.__transform = cv2.getPerspectiveTransform(origins, centers)
+        return self.__transform
+
+    def __check_alignment(self, result):
+        # A jump in the mean box diff usually means the stream was cropped or scaled differently, realign on the next frame
+        diff = result.diffs.mean()
+        if self.__frame_diff is not None and diff > max(FIDUCIAL_REALIGN_RATIO * self.__frame_diff, FIDUCIAL_MIN_DIFF):
+            self.msg.print("CODEC: box diff jumped from "+str(round(self.__frame_diff, 2))+" to "+str(round(diff, 2))+", realigning")
+            self.realign()
+            self.realign_count += 1
+            self.__frame_diff = None
+            return
+        self.__frame_diff = diff if self.__frame_diff is None else 0.9 * self.__frame_diff + 0.1 * diff
+
+    def realign(self):
+        # Look for the fiducials again on the next frame, realign_count counts how often the decoder asked for this
+        self.__transform_shape = None
+
+    def color_features(self, colors):
+        # Coordinates the classifier compares box colors in, plain BGR here
+        return np.asarray(colors, dtype=np.float64)
+
+    def __create_symbol_colors(self):
+        # Colors the classifier picks from and the symbol each one decodes to, white is always the last one
+        if self.symbol_mode == "binary":
+            # Spread over the whole palette, fewer bits per box then means more room between colors
+            colors = self.palette[np.linspace(0, len(self.palette) - 1, 1 << self.bits_per_box).round().astype(int)]
+        else:
+            colors = np.array([self.encode_map[c] for c in VALID_CHARS])
+        self.symbol_colors = np.vstack((colors, self.background_color)).astype(np.uint8)
+        self.symbol_values = np.append(np.arange(len(colors)), SYMBOL_WHITE)
 
-        return result_array
+        # What each symbol color looks like after the trip through the video stream, calibration moves these
+        self.__set_centroids(self.color_features(self.symbol_colors))
+        self.__symbol_chars = np.frombuffer(VALID_CHARS.encode("utf-8"), dtype=np.uint8)
 
-    
+    # All colors create_mapping picks from, in the same order
+    def create_palette(self, offset):
+        levels = range(offset, 255 - offset, offset)
+        return np.array([(r, g, b) for r in levels for g in levels for b in levels], dtype=np.uint8)
 
     # Create mapping
     def create_mapping(self, offset, chars):
@@ -295,6 +839,16 @@ class Codec:
         crc_bytes = crc8.crcValue.to_bytes(1, byteorder='big')
         base32_value = base64.b32encode(crc_bytes)
         return base32_value.decode()
+
+    def __getBinaryCRC(self, data):
+        # Starts from 0xFFFF, so a frame of all zero bytes doesn't carry a matching CRC of zero
+        crc16 = crcmod.predefined.Crc('crc-ccitt-false')
+        crc16.update(data)
+        return crc16.crcValue.to_bytes(BINARY_CRC_SIZE, byteorder='big')
+
+    def __is_blank(self, symbols):
+        # Every box the same symbol, e.g. a black or grey capture, no frame this codec sends looks like that
+        return len(symbols) > 0 and (symbols == symbols[0]).all()
     
     def debug(self, is_valid, msg_data, data, img, filename):
 
@@ -311,6 +865,24 @@ class Codec:
         self.debug_mode = value
 
 
+class DecodeResult:
+    # Per box soft decision decode, in fill order. Erasures are boxes with a confidence under the erasure threshold
+    def __init__(self, symbols, confidences, erasures, diffs, box_averages, image=None):
+        self.symbols = symbols
+        self.confidences = confidences
+        self.erasures = erasures
+        self.diffs = diffs
+        self.box_averages = box_averages
+        self.image = image
+        self.is_pilot = False
+        # Tiles that only decoded after combining several captures
+        self.recovered = 0
+
+    def tile(self, start, end):
+        return DecodeResult(self.symbols[start:end], self.confidences[start:end], self.erasures[start:end],
+                            self.diffs[start:end], self.box_averages[start:end], self.image)
+
+
 # ## Debugging
 # class Blah:
 #     def print(self, text):
@@ -0,0 +1,60 @@
+import numpy as np
+from . import rgb_grid
+
+# BT.601 luma weights for B, G and R, the same ones the video encoders use when converting to YUV
+LUMA_WEIGHTS = np.array([0.114, 0.587, 0.299])
+# Rows are Y, U and V, columns B, G and R, U and V are centered on 0 instead of 128
+BGR_TO_YUV = np.vstack((LUMA_WEIGHTS,
+                        0.564 * (np.array([1, 0, 0]) - LUMA_WEIGHTS),
+                        0.713 * (np.array([0, 0, 1]) - LUMA_WEIGHTS)))
+YUV_TO_BGR = np.linalg.inv(BGR_TO_YUV)
+
+# Luma levels stay away from the white gaps and the black border
+LUMA_MIN = 32
+LUMA_MAX = 208
+
+
+# Same grid as rgb_grid, but the palette is laid out in YUV and boxes line up with the encoder's blocks.
+# 4:2:0 keeps luma at full resolution and halves chroma, so most of the levels go into luma and only a few into U and V,
+# and with boxes on the 16x16 macroblock grid (which also lines up with the 2x2 chroma blocks) no chroma sample straddles two boxes.
+class Codec(rgb_grid.Codec):
+
+    BOX_ALIGN = 16
+
+    def configure(self, params=None):
+        self.luma_levels = 8
+        self.chroma_levels = 4
+        self.chroma_range = 64
+        if params:
+            self.luma_levels = params.get("luma_levels", self.luma_levels)
+            self.chroma_levels = params.get("chroma_levels", self.chroma_levels)
+            self.chroma_range = params.get("chroma_range", self.chroma_range)
+        super().configure(params)
+
+    def color_features(self, colors):
+        # Box colors are compared in YUV, so the distances match what the video encoder preserves
+        return np.asarray(colors, dtype=np.float64) @ BGR_TO_YUV.T
+
+    # All BGR colors in the YUV grid that survive the conversion back to BGR, luma first, offset is unused
+    def create_palette(self, offset):
+        luma = np.linspace(LUMA_MIN, LUMA_MAX, self.luma_levels)
+        chroma = np.linspace(-self.chroma_range, self.chroma_range, self.chroma_levels)
+        yuv = np.array([(y, u, v) for y in luma for u in chroma for v in chroma])
+        bgr = np.round(yuv @ YUV_TO_BGR.T)
+        return bgr[((bgr >= 0) & (bgr <= 255)).all(axis=1)].astype(np.uint8)
+
+    # Characters are spread evenly over the palette, map_range lists every channel value that is used
+    def create_mapping(self, offset, chars):
+        palette = self.create_palette(offset)
+        if len(palette) < len(chars):
+            print("WARNING: Not enough YUV values to map characters to!")
+        else:
+            palette = palette[np.linspace(0, len(palette) - 1, len(chars)).astype(int)]
+
+        encode_map = {}
+        decode_map = {}
+        for c, color in zip(chars, palette):
+            encode_map[c] = tuple(int(v) for v in color)
+            decode_map[str(encode_map[c])] = c
+        map_range = [255, 0] + [int(v) for v in np.unique(palette)]
+        return (encode_map, decode_map, map_range)
@@ -1,13 +1,32 @@
 import os, shutil
 import threading, queue
+import collections
 import subprocess
 import time
 import cv2, numpy as np
 import random
 from .lockvar import LockVar
+from .decodepool import DecodePool
+from .framering import FrameRing
+from .framecache import FrameCache
 from .config import Config
 config = Config()
 
+# Every packet starts with the stream nonce and a random nonce that makes resends look like new frames
+NONCE_LENGTH = 2
+
+# Once more than RECV_BATCH_BACKLOG images are waiting, they are decoded RECV_BATCH_SIZE at a time to catch up
+RECV_BATCH_BACKLOG = 10
+RECV_BATCH_SIZE = 8
+
+# The send loop reports frame rate and write latency percentiles over this many frames
+SEND_STATS_FRAMES = 100
+SEND_WRITE_PERCENTILES = (50, 95, 99)
+
+# Frames are compared as thumbnails with this many pixels per box step each way, so a single box that changed moves a thumbnail
+# pixel by most of its color change whatever the box size
+FINGERPRINT_BOX_PIXELS = 2
+
 
 class VideoStream:
 
@@ -18,29 +37,54 @@ class VideoStream:
         self.video_fps = self.params["video_fps"]
         self.width = self.params["video_width"]
         self.height = self.params["video_height"]
+        # "pipe" reads raw frames from ffmpeg's stdout, "bmp" has ffmpeg write numbered .bmp files to BMP_FILES_PATH
+        self.capture_mode = self.params.get("capture_mode", "pipe")
+        # Processes reading box colors from piped frames, 0 decodes everything on the recv thread
+        self.decode_workers = self.params.get("decode_workers", 0)
+        # Piped frames wait in a ring of this many shared memory slots, when it is full capture waits ("block")
+        # or the oldest frame that isn't being decoded yet is overwritten ("drop_oldest")
+        self.frame_ring_slots = self.params.get("frame_ring_slots", 2*self.decode_workers+4)
+        self.frame_ring_policy = self.params.get("frame_ring_policy", "block")
+        # The sender repeats each frame until it has a new packet, a captured frame whose thumbnail is within this of the last
+        # frame that decoded cleanly is skipped without decoding, 0 decodes every frame
+        self.duplicate_frame_diff = self.params.get("duplicate_frame_diff", 12)
+        self.clean_fingerprint = None
 
         self.msg = msg
         self.args = args
         self.local_seq = 0
         self.remote_seq = 0
         self.codec = codec(msg,params=config.STEGO_CODEC_PARAMS)
+        self.codec_lock = threading.Lock()
+        self.fingerprint_size = (-(-FINGERPRINT_BOX_PIXELS * self.codec.width // self.codec.box_step_x),
+                                 -(-FINGERPRINT_BOX_PIXELS * self.codec.height // self.codec.box_step_y))
         self.video_url = video_url
         self.sendThread = None
         self.recvThread = None
         self.send_q = queue.Queue()
+        # Called with each packet passed to send() once the frame carrying it starts going out
+        self.sent_callback = None
+        # Frames encoded ahead of the send loop, encode_ahead of them at most, as (packets, image)
+        self.ready_q = queue.Queue(maxsize=max(1, self.params.get("encode_ahead", 2)))
+        self.encodeThread = None
+        # Encoded packets by their bytes without the random nonce, resent packets are patched from here instead of encoded again
+        self.frame_cache = FrameCache(self.params.get("frame_cache_mb", 16))
         self.recv_q = queue.Queue()
         self.max_recv_q = 10
         self.ffmpeg_subprocess = None
         self.last_msg = None
+        self.recent_msgs = collections.deque(maxlen=2*self.codec.tiles)
         self.last_new_image = LockVar(None)
+        self.__snapshot_slot = None
         self.last_new_image_time = LockVar(0)
         self.last_valid_image_time = LockVar(0)
         self.status = "INITALIZING"
         self.stats = LockVar(VideoStreamStats())
+        self.stats.var.send_fps = self.send_fps
         self.stream_nonce = None
         self.stream_nonce_match = False
 
-        if os.path.exists(config.BMP_FILES_PATH) == False:
+        if self.capture_mode == "bmp" and os.path.exists(config.BMP_FILES_PATH) == False:
             os.makedirs(config.BMP_FILES_PATH)
         if os.path.exists(config.DEBUG_FILES_PATH) == False:
             os.makedirs(config.DEBUG_FILES_PATH)
@@ -54,8 +98,7 @@ class VideoStream:
 
     def __recvThread(self):
 
-
-        # Start ffmpeg process to capture frames as .bmp files
+        # Find the stream's media url, then start ffmpeg to capture frames from it
         cmd = config.YT_DLP+ " -f best -g "+self.video_url
 
         if os.path.isfile(config.YT_DLP) == False:
@@ -70,77 +113,316 @@ class VideoStream:
                 self.msg.print("Failed to connect to live stream. Is it live?")
                 time.sleep(1)
                 continue
-        
+
+        if self.capture_mode == "bmp":
+            self.__recvBmpFrames(source_url)
+        else:
+            self.__recvPipeFrames(source_url)
+
+    def __recvPipeFrames(self, source_url):
+        # ffmpeg writes bgr24 frames back to back on stdout, each one is read straight into a slot of the frame ring
+        frame_size = self.__probeFrameSize(source_url)
+        if frame_size is None:
+            frame_size = (self.width, self.height)
+            self.msg.print("Could not probe the stream's frame size, scaling it to "+str(frame_size))
+        width, height = frame_size
+
+        cmd = [config.FFMPEG, '-i', source_url, '-vf', 'fps='+str(self.recv_fps), '-s', f'{width}x{height}',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+        self.ffmpeg_subprocess = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.PIPE)
+
+        # One slot being written, one kept for last_new_image and the rest for frames waiting on or being decoded
+        ring = FrameRing(max(3, self.frame_ring_slots), (height, width, 3), self.frame_ring_policy == "drop_oldest")
+        if self.decode_workers > 0:
+            decode_thread = threading.Thread(target=self.__recvPoolFrames, args=(ring,), name="Thread-3")
+        else:
+            decode_thread = threading.Thread(target=self.__recvRingFrames, args=(ring,), name="Thread-3")
+        decode_thread.start()
+
+        frame_count = 0
+        ring_full = 0
+        while True:
+            slot, image = ring.claim()
+            if not self.__readFrame(self.ffmpeg_subprocess.stdout, image):
+                ring.cancel(slot)
+                break
+            ring.commit(slot)
+            frame_count += 1
+            with self.stats.lock:
+                self.stats.var.recv_backlog = ring.backlog()
+                self.stats.var.recv_dropped = ring.dropped
+                self.stats.var.recv_behind += ring.full - ring_full
+            ring_full = ring.full
+
+        ring.close()
+        with self.stats.lock:
+            self.stats.var.recv_dropped = ring.dropped
+        decode_thread.join()
+        # The snapshot can't point into the ring once it is gone
+        with self.last_new_image.lock:
+            if self.last_new_image.var is not None:
+                self.last_new_image.var = self.last_new_image.var.copy()
+        self.__snapshot_slot = None
+        ring.unlink()
+        self.msg.print("ffmpeg stopped sending frames after "+str(frame_count))
+
+    def __recvRingFrames(self, ring):
+        # Decode on this thread, frame by frame in ring order
+        while True:
+            item = ring.take()
+            if item is None:
+                break
+            frame_index, slot = item
+            start_time = time.time()
+            image = ring.frames[slot]
+            fingerprint = self.__get_fingerprint(image)
+            if self.__is_duplicate(fingerprint):
+                ring.release(slot)
+                continue
+            self.write_debug_image(image, "last_ffmpeg_recv.png", 2)
+            if self.args.debug > 1:
+                self.write_debug_image(self.codec.get_debug_image(image),"last_ffmpeg_recv_debug.png",2)
+
+            with self.codec_lock:
+                results = self.codec.decode_packets(image, "frame "+str(frame_index))
+                decode_result = self.codec.last_result
+            self.__process_recv_frame(image, results, decode_result, ring, slot)
+            self.__remember_fingerprint(fingerprint, results, decode_result)
+            ring.release(slot)
+
+            with self.stats.lock:
+                self.stats.var.recv_time += time.time()-start_time
+
+    def __recvPoolFrames(self, ring):
+        # Hand frames from the ring to the pool's workers, a second thread puts the results back in order
+        pool = DecodePool(self.codec, config.STEGO_CODEC_PARAMS, self.decode_workers, ring)
+        self.msg.print("Decoding with "+str(self.decode_workers)+" worker processes")
+        # Fingerprints of the frames with the workers, the results thread remembers the ones that decode cleanly
+        fingerprints = {}
+        results_thread = threading.Thread(target=self.__recvPoolResults, args=(ring, pool, fingerprints), name="Thread-4")
+        results_thread.start()
+
+        while True:
+            pool.wait_for_worker()
+            item = self.__take_new_frame(ring)
+            if item is None:
+                break
+            frame_index, slot, fingerprint = item
+            fingerprints[frame_index] = fingerprint
+            with self.codec_lock:
+                pool.submit(frame_index, slot, self.codec.realign_count)
+
+        pool.finish()
+        results_thread.join()
+        pool.close()
+
+    def __take_new_frame(self, ring):
+        # (frame_index, slot, fingerprint) of the next frame that isn't a duplicate, frames still with the workers aren't compared against
+        while True:
+            item = ring.take()
+            if item is None:
+                return None
+            frame_index, slot = item
+            fingerprint = self.__get_fingerprint(ring.frames[slot])
+            if not self.__is_duplicate(fingerprint):
+                return frame_index, slot, fingerprint
+            ring.release(slot)
+
+    def __recvPoolResults(self, ring, pool, fingerprints):
+        for frame_index, slot, box_averages, error in pool.get_results():
+            start_time = time.time()
+            image = ring.frames[slot]
+            fingerprint = fingerprints.pop(frame_index, None)
+            if error is not None:
+                self.msg.print("Decode worker failed on frame "+str(frame_index)+": "+error.strip().splitlines()[-1])
+                ring.release(slot)
+                continue
+
+            self.write_debug_image(image, "last_ffmpeg_recv.png", 2)
+            if self.args.debug > 1:
+                self.write_debug_image(self.codec.get_debug_image(image),"last_ffmpeg_recv_debug.png",2)
+
+            with self.codec_lock:
+                results = self.codec.decode_box_averages(box_averages, image, "frame "+str(frame_index))
+                decode_result = self.codec.last_result
+            self.__process_recv_frame(image, results, decode_result, ring, slot)
+            self.__remember_fingerprint(fingerprint, results, decode_result)
+            ring.release(slot)
+
+            with self.stats.lock:
+                self.stats.var.recv_time += time.time()-start_time
+                self.stats.var.decode_worker_utilization = pool.utilization()
+
+    def __get_fingerprint(self, image):
+        if self.duplicate_frame_diff <= 0:
+            return None
+        return cv2.resize(image, self.fingerprint_size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def __is_duplicate(self, fingerprint):
+        # Counts the skip, a frame is only a duplicate of one that decoded cleanly so repeats of a failed frame still get decoded
+        # and combined
+        clean_fingerprint = self.clean_fingerprint
+        if fingerprint is None or clean_fingerprint is None or clean_fingerprint.shape != fingerprint.shape:
+            return False
+        if np.abs(fingerprint - clean_fingerprint).max() > self.duplicate_frame_diff:
+            return False
+        with self.stats.lock:
+            self.stats.var.recv_skipped += 1
+        return True
+
+    def __remember_fingerprint(self, fingerprint, results, decode_result):
+        # Clean means every tile decoded or was all white, a tile that failed decodes to empty data as well so that can't tell
+        empty_tiles = self.codec.get_empty_tiles(decode_result)
+        if all(is_valid or is_empty for (is_valid, msg_data, data), is_empty in zip(results, empty_tiles)):
+            self.clean_fingerprint = fingerprint
+        else:
+            self.clean_fingerprint = None
+
+    def __readFrame(self, pipe, image):
+        # Fill image from the pipe, False once the pipe is closed
+        view = memoryview(image.reshape(-1))
+        filled = 0
+        while filled < len(view):
+            count = pipe.readinto(view[filled:])
+            if not count:
+                return False
+            filled += count
+        return True
+
+    def __probeFrameSize(self, source_url):
+        # (width, height) of the stream's video, or None if ffprobe can't tell
+        ffprobe = getattr(config, "FFPROBE", os.path.join(os.path.dirname(config.FFMPEG), "ffprobe"))
+        cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height', '-of', 'csv=s=x:p=0', source_url]
+        try:
+            output = subprocess.check_output(cmd, encoding='UTF-8', stderr=subprocess.DEVNULL)
+            width, height = output.split()[0].split("x")[:2]
+            return int(width), int(height)
+        except (OSError, subprocess.CalledProcessError, IndexError, ValueError):
+            return None
+
+    def __recvBmpFrames(self, source_url):
         cmd = config.FFMPEG + " -y -i '"+source_url+"' -vf fps="+str(self.recv_fps)+" ./"+config.BMP_FILES_PATH+"/out%d.bmp"
         self.ffmpeg_subprocess = subprocess.Popen(cmd, stderr=subprocess.DEVNULL, stdin=subprocess.PIPE, shell=True)
-        
+
+        def frame_number(f):
+            digits = "".join(c for c in f if c.isdigit())
+            return int(digits) if digits else 0
 
         while True:
-            files = os.listdir(config.BMP_FILES_PATH)
+            # Oldest first, listdir order is arbitrary
+            files = sorted((f for f in os.listdir(config.BMP_FILES_PATH) if ".bmp" in f), key=frame_number)
             with self.stats.lock:
                 self.stats.var.recv_backlog = len(files)
-            for f in files:
+                self.stats.var.recv_behind += max(0, len(files) - RECV_BATCH_BACKLOG)
+            batch_size = RECV_BATCH_SIZE if len(files) > RECV_BATCH_BACKLOG else 1
+            for index in range(0, len(files), batch_size):
                 start_time = time.time()
-
-                if ".bmp" not in f:
-                    continue
                 time.sleep(.1)
-                file_path = os.path.join(config.BMP_FILES_PATH,f)
-                image = cv2.imread(file_path)
+                names = files[index:index + batch_size]
+                images = [cv2.imread(os.path.join(config.BMP_FILES_PATH,f)) for f in names]
+                # Leave anything ffmpeg is still writing for the next pass
+                read_names = [f for f, image in zip(names, images) if image is not None]
+                images = [image for image in images if image is not None]
+                if len(images) == 0:
+                    continue
+                # Duplicates of the last clean frame are only compared against frames from earlier batches
+                fingerprints = [self.__get_fingerprint(image) for image in images]
+                duplicate = [self.__is_duplicate(fingerprint) for fingerprint in fingerprints]
+                names = [f for f, is_duplicate in zip(read_names, duplicate) if not is_duplicate]
+                images = [image for image, is_duplicate in zip(images, duplicate) if not is_duplicate]
+                fingerprints = [fingerprint for fingerprint, is_duplicate in zip(fingerprints, duplicate) if not is_duplicate]
+                if len(images) == 0:
+                    for f in read_names:
+                        self.__clean_up_recv_image(os.path.join(config.BMP_FILES_PATH,f), 0)
+                    continue
 
-                self.write_debug_image(image, "last_ffmpeg_recv.png", 2)
-                if self.args.debug > 1:
-                    self.write_debug_image(self.codec.get_debug_image(image),"last_ffmpeg_recv_debug.png",2)
-                
-                # Try to decode the image, msg_data will be binary data
-                is_valid, msg_data, data = self.codec.decode(image,f)
+                for image in images:
+                    self.write_debug_image(image, "last_ffmpeg_recv.png", 2)
+                    if self.args.debug > 1:
+                        self.write_debug_image(self.codec.get_debug_image(image),"last_ffmpeg_recv_debug.png",2)
 
-                with self.stats.lock:
-                    self.stats.var.recv_total+=1
-                    if is_valid:
-                        self.stats.var.recv_valid+=1
-                        self.stats.var.recv_err_factor+=data[2]
+                # Try to decode the images, one result per tile of each image, msg_data will be binary data
+                with self.codec_lock:
+                    if len(images) == 1:
+                        frame_results = [self.codec.decode_packets(images[0], names[0])]
                     else:
-                        self.stats.var.recv_crc_fail+=1
+                        frame_results = self.codec.decode_batch(images, names)
+                    decode_results = self.codec.last_results
 
-                    self.last_valid_image_time.set(time.time())
+                for image, results, decode_result, fingerprint in zip(images, frame_results, decode_results, fingerprints):
+                    self.__process_recv_frame(image, results, decode_result)
+                    self.__remember_fingerprint(fingerprint, results, decode_result)
 
-                # Get the stream_nonce from the packet
-                try:
-                    stream_nonce =(msg_data[:1])
-                except IndexError:
-                    self.__clean_up_recv_image(file_path, start_time)
-                    continue
-               
-                if self.stream_nonce != stream_nonce:
-                    with self.stats.lock:
-                        self.stats.var.recv_nonce_fail+=1
-                    self.__clean_up_recv_image(file_path, start_time)
-                    continue
-                elif self.stream_nonce_match == False:
-                    self.stream_nonce_match = True
-               
-                if self.last_msg == msg_data:
-                    self.__clean_up_recv_image(file_path, start_time)
-                    continue
-               
-                self.last_msg = msg_data
-                # Remove the stream nonce and the nonce that helps resends appear new
-                msg_data = msg_data[2:]
-                
+                frame_time = (time.time() - start_time) / len(read_names)
+                for f in read_names:
+                    self.__clean_up_recv_image(os.path.join(config.BMP_FILES_PATH,f), frame_time)
+
+    def __process_recv_frame(self, image, results, decode_result, ring=None, slot=None):
+        # Count the frame and queue every new packet in it
+        valid_results = [data for is_valid, msg_data, data in results if is_valid]
+
+        with self.stats.lock:
+            self.stats.var.recv_total+=1
+            if len(valid_results) > 0:
+                self.stats.var.recv_valid+=1
+                self.stats.var.recv_packets+=len(valid_results)
+                self.stats.var.recv_err_factor+=sum(data[2] for data in valid_results)/len(valid_results)
+                self.stats.var.recv_fec_corrected+=sum(data[3] for data in valid_results)
+                self.stats.var.recv_combined+=decode_result.recovered
+            elif decode_result.is_pilot:
+                self.stats.var.recv_pilot+=1
+            else:
+                self.stats.var.recv_crc_fail+=1
+
+            self.last_valid_image_time.set(time.time())
+
+        new_msg = False
+        for is_valid, msg_data, data in results:
+            if not is_valid:
+                continue
+
+            # Get the stream_nonce from the packet
+            stream_nonce = msg_data[:1]
+            if self.stream_nonce != stream_nonce:
                 with self.stats.lock:
-                    self.stats.var.recv_new+=1
-                
-                self.recv_q.put(msg_data)
-                self.__clean_up_recv_image(file_path, start_time)
-                self.write_debug_image(image, "last_recv_valid.png", 1)
-                self.write_debug_image(self.codec.get_debug_image(image),"last_recv_valid_debug.png",1)
-                self.last_new_image.set(image)
-                self.last_new_image_time.set(time.time())
-                
-                time.sleep(.05)
-                self.__setStatus()
-    def __clean_up_recv_image(self, file_path, start_time, out_file_path=None):
+                    self.stats.var.recv_nonce_fail+=1
+                continue
+            elif self.stream_nonce_match == False:
+                self.stream_nonce_match = True
+
+            # The same frame is captured several times, skip packets that were just seen
+            if msg_data in self.recent_msgs:
+                continue
+
+            self.last_msg = msg_data
+            self.recent_msgs.append(msg_data)
+            # Remove the stream nonce and the nonce that helps resends appear new
+            msg_data = msg_data[NONCE_LENGTH:]
+
+            with self.stats.lock:
+                self.stats.var.recv_new+=1
+
+            self.recv_q.put(msg_data)
+            new_msg = True
+
+        if new_msg == False:
+            return
+
+        self.write_debug_image(image, "last_recv_valid.png", 1)
+        self.write_debug_image(self.codec.get_debug_image(image),"last_recv_valid_debug.png",1)
+        if ring is not None:
+            # Keep the ring slot for last_new_image instead of copying the frame out, the previous one can be reused now
+            ring.hold(slot)
+            if self.__snapshot_slot is not None:
+                ring.release(self.__snapshot_slot)
+            self.__snapshot_slot = slot
+        self.last_new_image.set(image)
+        self.last_new_image_time.set(time.time())
+
+        time.sleep(.05)
+        self.__setStatus()
+
+    def __clean_up_recv_image(self, file_path, recv_time, out_file_path=None):
         if out_file_path:
             out_dir, f = os.path.split(out_file_path)
             if os.path.exists(out_dir) == False:
@@ -150,7 +432,7 @@ class VideoStream:
             os.remove(file_path)
 
         with self.stats.lock:
-            self.stats.var.recv_time += time.time()-start_time
+            self.stats.var.recv_time += recv_time
 
     # Perform everything needed to establish an outbound video stream
     def initSend(self, nonce_int, rtmp_url):
@@ -158,13 +440,41 @@ class VideoStream:
         self.send_rtmp_url = rtmp_url
         self.sendThread = threading.Thread(target=self.__sendThread, name="Thread-1")
         self.sendThread.start()
+        self.encodeThread = threading.Thread(target=self.__encodeThread, name="Thread-5", daemon=True)
+        self.encodeThread.start()
+
+    def __encodeThread(self):
+        # Turns queued packets into frames ahead of time, waits once encode_ahead frames are ready so the rest stay in send_q
+        last_checksum = 0
+        while True:
+            queued = [self.send_q.get()]
+            while len(queued) < self.codec.tiles:
+                try:
+                    queued.append(self.send_q.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = time.time()
+            cache_keys = [None if cache_key is None else self.stream_nonce+cache_key for packet, cache_key in queued]
+            packets = [self.stream_nonce+self.get_nonce()+packet for packet, cache_key in queued]
+            with self.codec_lock:
+                image = self.codec.encode_packets(packets, self.frame_cache, cache_keys)
+
+            if self.args.debug > 0:
+                checksum = np.sum(image)
+                if checksum != last_checksum:
+                    self.write_debug_image(image, "last_send_image.png",1)
+                    last_checksum = checksum
+            with self.stats.lock:
+                self.stats.var.send_time+=time.time()-start
+                self.stats.var.send_cache_hits = self.frame_cache.hits
+                self.stats.var.send_cache_misses = self.frame_cache.misses
+
+            self.ready_q.put((packets, image))
 
 
     def __sendThread(self):
 
-        def image_checksum(image):
-            return np.sum(image)
-       
 
         ffmpeg_cmd_stream = [
             'ffmpeg',
@@ -189,43 +499,103 @@ class VideoStream:
 
         ffmpeg_process_stream = subprocess.Popen(ffmpeg_cmd_stream, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
         #ffmpeg_process_stream = subprocess.Popen(ffmpeg_cmd_stream, stdin=subprocess.PIPE)
-        last_checksum = 0
         image = self.codec.encode(self.stream_nonce)
-        next_update = time.time()
+        # Until the first packet goes out, alternate the nonce image with a pilot frame the peer can calibrate colors from
+        idle_images = None
+        idle_index = 0
+        if self.codec.calibration:
+            idle_images = [image, self.codec.encode_pilot()]
+        # ffmpeg reads the same buffer every frame until the image changes, no bytes copy per write
+        frame = self.__get_frame_view(image)
+        frame_image = image
+        frame_count = 0
+        write_times = collections.deque(maxlen=SEND_STATS_FRAMES)
+        write_latencies = collections.deque(maxlen=SEND_STATS_FRAMES)
+        # Frames and image updates follow fixed schedules on the monotonic clock, so sleep overshoot doesn't add up
+        frame_interval = 1/self.video_fps
+        next_frame = time.monotonic()
+        next_update = next_frame
         while True:
-            if time.time() >= next_update:
+            if time.monotonic() >= next_update:
                 # This is the rate of the image being updated with data
-                next_update = time.time() + (1/self.send_fps)
-                start = time.time()
-                # Receive binary data from the queue, convert to encoded image
+                next_update = self.__next_tick(next_update, 1/self.send_fps)
+                # Swap in the next frame __encodeThread has ready
                 try:
-                    data = self.send_q.get_nowait()
-                    image = self.codec.encode(self.stream_nonce+self.get_nonce()+data)
+                    packets, ready_image = self.ready_q.get_nowait()
+                except queue.Empty:
+                    packets = []
+
+                if len(packets) > 0:
+                    image = ready_image
+                    idle_images = None
+                    if self.sent_callback:
+                        for packet in packets:
+                            self.sent_callback(packet[NONCE_LENGTH:])
 
                     with self.stats.lock:
-                        self.stats.var.send_total+=1
-                except queue.Empty:
-                    pass
+                        self.stats.var.send_total+=len(packets)
+                elif idle_images:
+                    idle_index = (idle_index + 1) % len(idle_images)
+                    image = idle_images[idle_index]
 
                 if image is None:
                     time.sleep(.25)
+                    next_frame = time.monotonic()
                     continue
-                if self.args.debug > 0:
-                    checksum = image_checksum(image)
-                    if checksum != last_checksum:
-                        self.write_debug_image(image, "last_send_image.png",1)
-                        last_checksum = checksum
-                    with self.stats.lock:
-                        self.stats.var.send_time+=time.time()-start
-                
-            ffmpeg_process_stream.stdin.write(image.tobytes())
+                if frame_image is not image:
+                    frame = self.__get_frame_view(image)
+                    frame_image = image
+
+            write_start = time.monotonic()
+            ffmpeg_process_stream.stdin.write(frame)
             ffmpeg_process_stream.stdin.flush()
+            write_times.append(write_start)
+            write_latencies.append(time.monotonic() - write_start)
+            frame_count += 1
+            if frame_count % self.video_fps == 0:
+                self.__update_send_stats(write_times, write_latencies)
+
             # This is the stream rate of the underlying video stream
-            time.sleep(1/(self.video_fps+(self.video_fps*.1)))
+            next_frame = self.__next_tick(next_frame, frame_interval)
+            time.sleep(max(0, next_frame - time.monotonic()))
+
+    def __get_frame_view(self, image):
+        # Flat byte view of the image for writing to ffmpeg, the image is only copied if it isn't contiguous already
+        return memoryview(np.ascontiguousarray(image)).cast("B")
+
+    def __next_tick(self, tick, interval):
+        # The tick after this one, when the loop fell more than a tick behind it starts over from now instead of catching up in a burst
+        tick += interval
+        now = time.monotonic()
+        if now - tick > interval:
+            return now
+        return tick
+
+    def __update_send_stats(self, write_times, write_latencies):
+        # Frames per second over the last SEND_STATS_FRAMES writes, and how long the writes took
+        latencies = np.array(write_latencies) * 1000
+        with self.stats.lock:
+            if len(write_times) > 1:
+                self.stats.var.send_frame_rate = round((len(write_times) - 1) / max(write_times[-1] - write_times[0], 1e-6), 2)
+            self.stats.var.send_write_ms = {str(p): round(float(np.percentile(latencies, p)), 2) for p in SEND_WRITE_PERCENTILES}
+
 
+    def send(self, data, cache_key=None):
+        # cache_key names the packet without the bytes that change from one send of it to the next, a packet sent again with
+        # the same key is patched from its earlier encoding (see FrameCache). None encodes it from scratch
+        self.send_q.put((data, cache_key))
+
+    def set_send_fps(self, fps, reason=None):
+        # How often the image is updated with data, ffmpeg still writes video_fps frames either way
+        self.send_fps = fps
+        with self.stats.lock:
+            self.stats.var.send_fps = fps
+            self.stats.var.send_fps_change = reason
+        self.msg.print("send_fps is now "+str(fps)+(" ("+reason+")" if reason else ""),1)
 
-    def send(self, data):
-        self.send_q.put(data)
+    def get_payload_capacity(self):
+        # Bytes of each packet passed to send() that fit in one tile of the current codec params
+        return self.codec.get_payload_capacity() - NONCE_LENGTH
 
 
     def __setStatus(self):
@@ -274,11 +644,30 @@ class VideoStreamStats:
     def __init__(self):
         self.send_total = 0
         self.send_time = 0
+        # Frames per second written to ffmpeg and write latency percentiles in ms, e.g. {"50": 0.8, "95": 1.2, "99": 3.0}
+        self.send_frame_rate = 0
+        self.send_cache_hits = 0
+        self.send_cache_misses = 0
+        self.send_write_ms = {}
+        # Current image update rate and why rate control last changed it
+        self.send_fps = 0
+        self.send_fps_change = None
+        # Frames decoded, recv_skipped counts the ones that weren't because they repeated the last clean frame
         self.recv_total = 0
+        self.recv_skipped = 0
         self.recv_time = 0
         self.recv_valid = 0
+        self.recv_packets = 0
         self.recv_crc_fail = 0
         self.recv_new = 0
         self.recv_backlog = 0
         self.recv_nonce_fail = 0
         self.recv_err_factor = 0
+        self.recv_fec_corrected = 0
+        self.recv_pilot = 0
+        self.recv_combined = 0
+        self.recv_dropped = 0
+        # Captured frames that found the decoder behind, the ring was full or more than RECV_BATCH_BACKLOG images were waiting
+        self.recv_behind = 0
+        # Percent busy of each decode worker process, empty without a pool
+        self.decode_worker_utilization = []
@@ -0,0 +1,54 @@
+import threading
+import numpy as np
+from lib.framering import FrameRing
+from lib.decodepool import DecodePool
+from lib.stegocodecs import rgb_grid
+
+FRAME_SHAPE = (720, 1280, 3)
+PARAMS = {
+    "width" : 1280,
+    "height" : 720,
+    "num_boxes_x" : 40,
+    "num_boxes_y" : 35,
+    "gap_size" : 2,
+    "box_reduction" : True,
+}
+
+
+class Messages:
+    def __init__(self):
+        self.lines = []
+
+    def print(self, text, verbose=0):
+        self.lines.append(text)
+
+
+def test_get_results_returns_when_a_worker_dies():
+    msg = Messages()
+    codec = rgb_grid.Codec(msg, params=PARAMS)
+    ring = FrameRing(4, FRAME_SHAPE)
+    pool = DecodePool(codec, PARAMS, 2, ring)
+    results = []
+    results_thread = threading.Thread(target=lambda: results.extend(pool.get_results()), daemon=True)
+    results_thread.start()
+    try:
+        submitted = []
+        for frame_index in range(4):
+            pool.wait_for_worker()
+            slot, frame = ring.claim()
+            frame[:] = codec.encode(b"frame " + bytes([frame_index]))
+            ring.commit(slot)
+            seq, slot = ring.take()
+            pool.submit(seq, slot, 0)
+            submitted.append(seq)
+            if frame_index == 1:
+                pool.processes[0].terminate()
+        pool.finish()
+        results_thread.join(timeout=60)
+        assert not results_thread.is_alive()
+        # Every frame comes back, in order, whether it was decoded or lost with the worker
+        assert [result[0] for result in results] == submitted
+        assert any("died" in line for line in msg.lines)
+    finally:
+        pool.close()
+        ring.unlink()
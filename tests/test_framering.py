@@ -0,0 +1,67 @@
+import threading
+from lib.framering import FrameRing
+
+FRAME_SHAPE = (4, 4, 3)
+
+
+def test_full_counts_claims_that_found_no_free_slot():
+    ring = FrameRing(3, FRAME_SHAPE, drop_oldest=True)
+    try:
+        for frame_index in range(5):
+            slot, frame = ring.claim()
+            ring.commit(slot)
+        # The first three claims found a free slot, the last two overwrote the oldest ready frame
+        assert ring.full == 2
+        assert ring.dropped == 2
+    finally:
+        ring.unlink()
+
+
+def test_drop_oldest_overwrites_the_oldest_ready_frame():
+    ring = FrameRing(3, FRAME_SHAPE, drop_oldest=True)
+    try:
+        for frame_index in range(3):
+            slot, frame = ring.claim()
+            frame[:] = frame_index
+            ring.commit(slot)
+        # Held by a consumer, so it is never overwritten
+        seq, held = ring.take()
+        assert seq == 0
+        for frame_index in range(3, 6):
+            slot, frame = ring.claim()
+            assert slot != held
+            frame[:] = frame_index
+            ring.commit(slot)
+        assert ring.dropped == 3
+        # Frames 1 to 3 were overwritten, the rest come out oldest first
+        taken = []
+        for count in range(2):
+            seq, slot = ring.take()
+            assert (ring.frames[slot] == seq).all()
+            taken.append(seq)
+            ring.release(slot)
+        assert taken == [4, 5]
+        assert ring.backlog() == 0
+    finally:
+        ring.unlink()
+
+
+def test_block_waits_for_a_released_slot():
+    ring = FrameRing(2, FRAME_SHAPE)
+    try:
+        for frame_index in range(2):
+            slot, frame = ring.claim()
+            ring.commit(slot)
+        seq, slot = ring.take()
+        claimed = []
+        producer = threading.Thread(target=lambda: claimed.append(ring.claim()))
+        producer.start()
+        producer.join(timeout=0.2)
+        assert producer.is_alive()
+        ring.release(slot)
+        producer.join(timeout=5)
+        assert claimed[0][0] == slot
+        assert ring.dropped == 0
+        assert ring.full == 1
+    finally:
+        ring.unlink()
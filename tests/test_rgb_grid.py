@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from lib.framecache import FrameCache
+from lib.stegocodecs import rgb_grid, yuv_grid
+
+
+class Messages:
+    def print(self, text, verbose=0):
+        pass
+
+
+def get_params(**params):
+    return dict({
+        "width" : 1280,
+        "height" : 720,
+        "num_boxes_x" : 40,
+        "num_boxes_y" : 35,
+        "gap_size" : 2,
+        "box_reduction" : True,
+        "symbol_mode" : "binary",
+    }, **params)
+
+
+@pytest.mark.parametrize("fec_parity", [0, 16])
+@pytest.mark.parametrize("level", [0, 128])
+def test_solid_frame_is_invalid(fec_parity, level):
+    # A black or grey capture must not decode as an empty packet
+    codec = rgb_grid.Codec(Messages(), params=get_params(fec_parity=fec_parity))
+    image = np.full((720, 1280, 3), level, dtype=np.uint8)
+    valid, data, info = codec.decode(image)
+    assert not valid
+
+
+@pytest.mark.parametrize("fec_parity", [0, 16])
+def test_binary_round_trip(fec_parity):
+    codec = rgb_grid.Codec(Messages(), params=get_params(fec_parity=fec_parity))
+    payload = bytes(range(100))
+    valid, data, info = codec.decode(codec.encode(payload))
+    assert valid
+    assert data == payload
+
+
+@pytest.mark.parametrize("codec_module", [rgb_grid, yuv_grid])
+def test_low_bits_spread_over_the_palette(codec_module):
+    # Fewer bits per box should buy more distance between the colors, not just the first few of the palette
+    codec = codec_module.Codec(Messages(), params=get_params(bits_per_box=1))
+    colors = codec.symbol_colors[:-1]
+    assert (colors[0] == codec.palette[0]).all()
+    assert (colors[-1] == codec.palette[-1]).all()
+    valid, data, info = codec.decode(codec.encode(bytes(range(20))))
+    assert valid
+    assert data == bytes(range(20))
+
+
+@pytest.mark.parametrize("num_boxes", [(15, 12), (40, 35)])
+def test_aligned_grid_fills_the_frame(num_boxes):
+    codec = yuv_grid.Codec(Messages(), params=get_params(num_boxes_x=num_boxes[0], num_boxes_y=num_boxes[1]))
+    assert codec.box_step_x % 16 == 0 and codec.box_step_y % 16 == 0
+    # No room is left at the right or bottom for another column or row of boxes
+    assert 1280 - codec.box_step_x < codec.num_boxes_x * codec.box_step_x - codec.gap_size <= 1280
+    assert 720 - codec.box_step_y < codec.num_boxes_y * codec.box_step_y - codec.gap_size <= 720
+    valid, data, info = codec.decode(codec.encode(bytes(range(100))))
+    assert valid
+    assert data == bytes(range(100))
+
+
+def test_failed_tile_is_not_empty():
+    codec = rgb_grid.Codec(Messages(), params=get_params(tiles=2))
+    image = codec.encode_packets([bytes(range(20))])
+    # Whiten the first box, the header no longer parses and the tile comes back with empty data
+    x, y = codec.box_x[0], codec.box_y[0]
+    image[y:y + codec.box_size_y, x:x + codec.box_size_x] = 255
+    results = codec.decode_packets(image)
+    assert [is_valid for is_valid, data, info in results] == [False, False]
+    assert results[0][1] == b""
+    assert codec.get_empty_tiles(codec.last_result) == [False, True]
+
+
+def test_cache_is_skipped_without_fec():
+    codec = rgb_grid.Codec(Messages(), params=get_params())
+    cache = FrameCache(1)
+    for nonce in range(3):
+        image = codec.encode_packets([bytes([nonce]) + bytes(range(20))], cache, [b"key"])
+        assert (image == codec.encode_packets([bytes([nonce]) + bytes(range(20))])).all()
+    assert cache.hits == 0 and cache.misses == 0
+
+
+@pytest.mark.parametrize("tiles", [1, 2])
+def test_patched_codeword_matches_a_fresh_encode(tiles):
+    # Resends differ in the nonce and the ack, the cached Reed-Solomon codeword is patched for the bytes that changed
+    codec = rgb_grid.Codec(Messages(), params=get_params(fec_parity=16, tiles=tiles))
+    cache = FrameCache(1)
+    for send in range(4):
+        packet = bytes([send, 255 - send]) + bytes(range(40))
+        image = codec.encode_packets([packet] * tiles, cache, [b"key"] * tiles)
+        assert (image == codec.encode_packets([packet] * tiles)).all()
+    assert cache.hits == 3 * tiles
+    assert cache.misses == tiles
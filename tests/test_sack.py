@@ -0,0 +1,29 @@
+from lib.peerconnection import get_sack_bitmap, get_sack_missing, get_sack_received
+
+
+def test_bitmap_marks_seqs_past_the_ack():
+    # ack 10 is missing, 11 and 13 arrived, bit i stands for ack+1+i
+    assert get_sack_bitmap(10, [11, 13], 4) == bytes([0b10100000])
+    assert get_sack_bitmap(10, [19], 4) == bytes([0, 0b10000000])
+
+
+def test_bitmap_is_empty_without_anything_past_the_ack():
+    assert get_sack_bitmap(10, [], 4) == b""
+    assert get_sack_bitmap(10, [8, 9, 10], 4) == b""
+
+
+def test_bitmap_is_cut_at_max_bytes():
+    assert get_sack_bitmap(10, [12, 10 + 8 + 1], 1) == bytes([0b01000000])
+    assert get_sack_bitmap(10, [10 + 8 + 1], 1) == b""
+
+
+def test_received_and_missing_round_trip():
+    received = [12, 13, 17, 30]
+    bitmap = get_sack_bitmap(10, received, 4)
+    assert get_sack_received(10, bitmap) == received
+    assert get_sack_missing(10, bitmap) == [10, 11, 14, 15, 16] + list(range(18, 30))
+
+
+def test_nothing_is_missing_without_a_bitmap():
+    assert get_sack_received(10, b"") == []
+    assert get_sack_missing(10, b"") == []
@@ -0,0 +1,19 @@
+import pytest
+from lib.sendfile import OutgoingFile
+
+
+@pytest.mark.parametrize("chunk_size", [0, -1])
+def test_get_file_chunks_rejects_empty_chunks(tmp_path, chunk_size):
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"some file data")
+    with pytest.raises(ValueError):
+        next(OutgoingFile(str(path)).get_file_chunks(chunk_size))
+
+
+def test_get_file_chunks_covers_the_file(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(bytes(range(256)) * 8)
+    chunks = list(OutgoingFile(str(path)).get_file_chunks(7))
+    assert chunks[0][0] == 1
+    assert chunks[-1][0] == 4
+    assert all(len(chunk) <= 7 for flag, chunk in chunks)
@@ -0,0 +1,14 @@
+from lib.peerconnection import SendWindow, INITIAL_WINDOW
+
+
+def test_acking_a_seq_twice_frees_one_slot():
+    window = SendWindow()
+    for seq in range(1, INITIAL_WINDOW + 1):
+        window.acquire()
+        window.add(seq)
+    # A SACK acks 2, then the ack passing it reports 1 and 2 again
+    window.acked([2], None)
+    window.acked([1, 2], None)
+    assert window.in_flight == INITIAL_WINDOW - 2
+    window.acked([1, 2, 7], None)
+    assert window.in_flight == INITIAL_WINDOW - 2
@@ -0,0 +1,27 @@
+import pytest
+from lib.peerconnection import SEQ_MODULUS, get_serial_bytes, serial_distance, expand_serial
+
+
+@pytest.mark.parametrize("a, b, distance", [
+    (5, 3, 2),
+    (3, 5, -2),
+    (0, 65535, 1),
+    (65535, 0, -1),
+    (2, 65530, 8),
+    (65530, 2, -8),
+])
+def test_serial_distance_across_the_wrap(a, b, distance):
+    assert serial_distance(a, b) == distance
+
+
+@pytest.mark.parametrize("seq, reference", [
+    (65534, 65530),
+    (65536, 65530),
+    (65541, 65534),
+    (65530, 65541),
+    (3 * SEQ_MODULUS + 7, 3 * SEQ_MODULUS - 9),
+])
+def test_expand_serial_recovers_the_seq(seq, reference):
+    serial = int.from_bytes(get_serial_bytes(seq), byteorder='big')
+    assert serial == seq % SEQ_MODULUS
+    assert expand_serial(serial, reference) == seq